@@ -0,0 +1,867 @@
+# python bench.py [--concurrency 32] [--requests 2000] [--output bench_results.json] [scenario ...]
+#
+# Boots main.app in process with fake Google Publisher, Firestore and SMTP
+# backends and drives its routes over ASGI. Every run works on copies of
+# institutes.json and data in a temporary directory, so the checkout is never
+# modified. Throughput and p50/p95/p99 latencies of every scenario are written
+# to the output file, together with the commit and settings, so runs from
+# different commits can be compared.
+import argparse
+import asyncio
+import contextlib
+import functools
+import http.server
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import smtplib
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import httpx
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+class Backend:
+    # Every call to a fake backend counts as one round trip and sleeps for
+    # latency seconds, on whatever thread the app made the call from.
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def round_trip(self):
+        with self.lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+
+class FakeRequest:
+    def __init__(self, backend, fn):
+        self.backend = backend
+        self.fn = fn
+
+    def execute(self, http=None):
+        self.backend.round_trip()
+        return self.fn()
+
+
+class FakeBatchRequest:
+    def __init__(self, backend, callback):
+        self.backend = backend
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id=None):
+        self.requests.append((request_id, request))
+
+    def execute(self, http=None):
+        self.backend.round_trip()
+        for request_id, request in self.requests:
+            self.callback(request_id, request.fn(), None)
+
+
+class FakePublisher(Backend):
+    # Stands in for both discovery.build(...) and its inappproducts() resource.
+
+    def __init__(self, products=100, latency=0.0):
+        super().__init__(latency)
+        self.products = {}
+        for i in range(products):
+            sku = 'bench_product_%d' % i
+            self.products[sku] = {
+                'sku': sku,
+                'status': 'active',
+                'purchaseType': 'managedUser',
+                'defaultPrice': {'priceMicros': str((i + 1) * 990000), 'currency': 'USD'},
+                'listings': {'en-US': {'title': 'Product %d' % i, 'description': 'Benchmark product'}},
+            }
+
+    def list(self, packageName):
+        return FakeRequest(self, lambda: {'kind': 'androidpublisher#inappproductsListResponse',
+                                          'inappproduct': list(self.products.values())})
+
+    def put(self, body):
+        self.products[body['sku']] = body
+        return body
+
+    def update(self, packageName, sku, body, autoConvertMissingPrices=False):
+        return FakeRequest(self, lambda: self.put(body))
+
+    def insert(self, packageName, body, autoConvertMissingPrices=False):
+        return FakeRequest(self, lambda: self.put(body))
+
+    def delete(self, packageName, sku):
+        return FakeRequest(self, lambda: self.products.pop(sku, None) and None)
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatchRequest(self, callback)
+
+
+class FakeSnapshot:
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self.data = data
+        self.exists = data is not None
+
+    def to_dict(self):
+        return None if self.data is None else dict(self.data)
+
+
+class FakeDocument:
+    def __init__(self, db, collection, id):
+        self.db = db
+        self.collection = collection
+        self.id = id
+
+    def get(self):
+        self.db.round_trip()
+        return FakeSnapshot(self, self.db.collections.get(self.collection, {}).get(self.id))
+
+    def set(self, fields):
+        self.db.round_trip()
+        self.db.collections.setdefault(self.collection, {})[self.id] = dict(fields)
+
+    def update(self, fields):
+        self.db.round_trip()
+        self.db.missing(self)
+        self.db.collections[self.collection][self.id].update(fields)
+
+    def delete(self):
+        self.db.round_trip()
+        self.db.collections.get(self.collection, {}).pop(self.id, None)
+
+
+class FakeQuery:
+    def __init__(self, db, collection, limit=None):
+        self.db = db
+        self.collection = collection
+        self.count = limit
+
+    def document(self, id):
+        return FakeDocument(self.db, self.collection, id)
+
+    def limit(self, count):
+        return FakeQuery(self.db, self.collection, count)
+
+    def get(self):
+        # A query is one round trip however many documents it returns.
+        self.db.round_trip()
+        documents = self.db.collections.get(self.collection, {})
+        return [FakeSnapshot(self.document(id), documents[id]) for id in list(documents)[:self.count]]
+
+
+class FakeBatch:
+    def __init__(self, db):
+        self.db = db
+        self.writes = []
+
+    def set(self, doc, fields):
+        self.writes.append(('set', doc, fields))
+
+    def update(self, doc, fields):
+        self.writes.append(('update', doc, fields))
+
+    def delete(self, doc):
+        self.writes.append(('delete', doc, None))
+
+    def commit(self):
+        # All or nothing, like Firestore: one update of a missing document
+        # fails the whole batch.
+        self.db.round_trip()
+        for op, doc, fields in self.writes:
+            if op == 'update':
+                self.db.missing(doc)
+        self.db.commits += 1
+        for op, doc, fields in self.writes:
+            documents = self.db.collections.setdefault(doc.collection, {})
+            if op == 'set':
+                documents[doc.id] = dict(fields)
+            elif op == 'update':
+                documents[doc.id].update(fields)
+            else:
+                documents.pop(doc.id, None)
+
+
+class FakeFirestore(Backend):
+    def __init__(self, latency=0.0):
+        super().__init__(latency)
+        self.collections = {}
+        self.commits = 0
+
+    def collection(self, name):
+        return FakeQuery(self, name)
+
+    def batch(self):
+        return FakeBatch(self)
+
+    def get_all(self, references):
+        self.round_trip()
+        return [FakeSnapshot(doc, self.collections.get(doc.collection, {}).get(doc.id)) for doc in references]
+
+    def missing(self, doc):
+        if doc.id not in self.collections.get(doc.collection, {}):
+            from google.api_core.exceptions import NotFound
+            raise NotFound('No document to update: %s/%s' % (doc.collection, doc.id))
+
+
+class FakeSMTP:
+    # Replaces smtplib.SMTP and smtplib.SMTP_SSL, sent messages are only
+    # counted.
+    backend = Backend()
+    sent = 0
+    receivers = {}
+
+    def __init__(self, host=None, port=None, timeout=None, context=None):
+        self.backend.round_trip()
+
+    def login(self, user, password):
+        self.backend.round_trip()
+
+    def noop(self):
+        return 250, b'OK'
+
+    def sendmail(self, sender, receiver, message):
+        self.backend.round_trip()
+        FakeSMTP.sent += 1
+        FakeSMTP.receivers[receiver] = FakeSMTP.receivers.get(receiver, 0) + 1
+
+    def quit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class WebSocketClient:
+    # Talks ASGI to the app directly, httpx's ASGI transport only does HTTP.
+
+    def __init__(self, app, path):
+        self.incoming = asyncio.Queue()
+        self.outgoing = asyncio.Queue()
+        scope = {'type': 'websocket', 'asgi': {'version': '3.0'}, 'scheme': 'ws', 'path': path,
+                 'raw_path': path.encode(), 'root_path': '', 'query_string': b'', 'headers': [],
+                 'client': ('127.0.0.1', 0), 'server': ('bench', 80), 'subprotocols': []}
+        self.task = asyncio.ensure_future(app(scope, self.incoming.get, self.outgoing.put))
+
+    async def connect(self):
+        await self.incoming.put({'type': 'websocket.connect'})
+        return (await self.outgoing.get())['type'] == 'websocket.accept'
+
+    async def receive_json(self):
+        return json.loads((await self.outgoing.get())['text'])
+
+    async def disconnect(self, timeout=1.0):
+        await self.incoming.put({'type': 'websocket.disconnect', 'code': 1000})
+        await asyncio.wait([self.task], timeout=timeout)
+
+
+def percentile(latencies, p):
+    if not latencies:
+        return None
+    return latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))]
+
+
+async def drive(client, requests, concurrency):
+    # concurrency clients send requests back to back, each one is timed from
+    # send until its response body has been read.
+    requests = iter(requests)
+    latencies = []
+    statuses = {}
+
+    async def run():
+        for method, url, body in requests:
+            start = time.perf_counter()
+            try:
+                response = await client.request(method, url, json=body)
+                status = str(response.status_code)
+            except Exception as e:
+                status = type(e).__name__
+            latencies.append(time.perf_counter() - start)
+            statuses[status] = statuses.get(status, 0) + 1
+            # A request that never suspends would let this client run on
+            # alone, a real connection yields while it reads the socket.
+            await asyncio.sleep(0)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[run() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'concurrency': concurrency,
+        'seconds': round(elapsed, 4),
+        'throughput': round(len(latencies) / elapsed, 1) if elapsed else None,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3) if latencies else None,
+        'p95_ms': round(percentile(latencies, 95) * 1000, 3) if latencies else None,
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3) if latencies else None,
+        'max_ms': round(latencies[-1] * 1000, 3) if latencies else None,
+        'statuses': statuses,
+    }
+
+
+class Bench:
+    def __init__(self, main, client, args):
+        self.main = main
+        self.client = client
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.institutes = main.store.all()
+        self.domains = [domain for item in self.institutes for domain in item['domains']]
+
+    def lookups(self, count):
+        for _ in range(count):
+            roll = self.random.random()
+            domain = self.random.choice(self.domains)
+            if roll < 0.1:
+                domain = 'unknown-%d.example' % self.random.randrange(1000000)
+            elif roll < 0.4:
+                domain = 'mail.' + domain
+            yield 'GET', '/find-institute/' + domain, None
+
+    async def run(self, requests, concurrency=None):
+        return await drive(self.client, requests, concurrency or self.args.concurrency)
+
+    async def lookup(self):
+        return await self.run(self.lookups(self.args.requests))
+
+    async def search(self):
+        def requests():
+            for _ in range(self.args.requests):
+                name = self.random.choice(self.institutes)['name']
+                yield 'GET', '/search-institutes?q=' + name[:self.random.randint(1, 8)], None
+        return await self.run(requests())
+
+    async def institutions(self):
+        countries = list({item['country'] for item in self.institutes if item.get('country')}) or ['']
+
+        def requests():
+            for i in range(self.args.requests):
+                if i % 3 == 0:
+                    yield 'GET', '/institutions', None
+                elif i % 3 == 1:
+                    yield 'GET', '/institutions?country=%s&limit=50' % self.random.choice(countries), None
+                else:
+                    yield 'GET', '/institutions?offset=%d&limit=100' % self.random.randrange(len(self.institutes)), None
+        return await self.run(requests())
+
+    async def admin_writes(self):
+        # Bursts of institute CRUD: create, update, batch upsert, delete. Every
+        # institute created here is deleted again.
+        def institute(i, verified=False):
+            return {'name': 'Bench Institute %d' % i, 'domains': ['bench%d.example.edu' % i],
+                    'web_pages': ['https://bench%d.example.edu' % i], 'is_verified': verified,
+                    'alpha_two_code': 'US'}
+
+        def requests():
+            for i in range(self.args.requests // 4):
+                yield 'POST', '/new-institute', institute(i)
+                yield 'POST', '/update-institute/Bench Institute %d' % i, institute(i, True)
+                yield 'POST', '/upsert-institutes', [institute(i), institute(i + 1000000)]
+                yield 'POST', '/delete-institute/Bench Institute %d' % i, None
+            for i in range(self.args.requests // 4):
+                yield 'POST', '/delete-institute/Bench Institute %d' % (i + 1000000), None
+        result = await self.run(requests())
+        await self.main.store.save()
+        return result
+
+    async def catalog(self):
+        return await self.run(('GET', '/get-products', None) for _ in range(self.args.requests))
+
+    async def product_writes(self):
+        def product(i, price):
+            return {'id': 'bench_product_%d' % i, 'name': 'Product %d' % i, 'type': 'managedUser',
+                    'price': price, 'discount': round(price * 0.8, 2), 'description': 'Benchmark product',
+                    'discountMode': i % 2 == 0, 'subscriptionPeriod': ''}
+
+        def requests():
+            # Every tenth request is a 20 product bulk update.
+            for i in range(self.args.requests):
+                if i % 10 == 0:
+                    yield 'POST', '/update-products', [product(j, 4.99 + j % 5) for j in range(20)]
+                else:
+                    yield 'POST', '/update-product', product(i % 100, 9.99 + i % 7)
+        return await self.run(requests())
+
+    async def email_links(self):
+        # Half of the requests link an email, the other half confirm requests
+        # seeded straight into the fake Firestore.
+        count = self.args.requests // 2
+        users = self.main.db.collections.setdefault('v2_users', {})
+        confirmations = self.main.db.collections.setdefault('v2_institute_confirmations', {})
+        for i in range(count):
+            users['bench-user-%d' % i] = {'name': 'User %d' % i}
+            confirmations['bench-confirm-%d' % i] = {
+                'user': 'bench-user-%d' % i,
+                'email': 'student%d@%s' % (i, self.random.choice(self.domains)),
+            }
+
+        def requests():
+            for i in range(count):
+                yield 'GET', '/link-institute-email/student%d@%s/bench-user-%d' % (
+                    i, self.random.choice(self.domains), i), None
+                yield 'GET', '/confirm-institute-email/bench-confirm-%d' % i, None
+        result = await self.run(requests())
+        result['firestore_commits'] = self.main.db.commits
+        return result
+
+    async def every_route(self):
+        # One pass over every HTTP route, the websocket is left out since
+        # httpx cannot open one over ASGI.
+        fixture = os.path.join(os.getcwd(), 'bench-source.json')
+        with open(fixture, 'w') as source:
+            source.write(json.dumps([dict(item, country='Benchmark') for item in self.institutes]))
+        self.main.INSTITUTES_SOURCE = fixture
+
+        item = self.institutes[0]
+        product = {'id': 'bench_product_0', 'name': 'Product 0', 'type': 'managedUser', 'price': 1.99,
+                   'discount': 0.99, 'description': 'Benchmark product', 'discountMode': False,
+                   'subscriptionPeriod': ''}
+        institute = {'name': 'Bench Route Institute', 'domains': ['route.example.edu'], 'web_pages': [],
+                     'is_verified': True, 'alpha_two_code': 'US'}
+        self.main.db.collections.setdefault('v2_users', {})['bench-route-user'] = {}
+
+        def requests():
+            for _ in range(max(1, self.args.requests // 20)):
+                yield 'GET', '/find-institute/' + item['domains'][0], None
+                yield 'GET', '/search-institutes?q=' + item['name'][:4], None
+                yield 'GET', '/institutions', None
+                yield 'GET', '/get-products', None
+                yield 'POST', '/update-product', product
+                yield 'POST', '/update-products', [product]
+                yield 'POST', '/new-product', dict(product, id='bench_new_product')
+                yield 'DELETE', '/delete-product/bench_new_product', None
+                yield 'POST', '/new-institute', institute
+                yield 'POST', '/update-institute/' + institute['name'], institute
+                yield 'POST', '/upsert-institutes', [institute]
+                yield 'POST', '/delete-institute/' + institute['name'], None
+                yield 'GET', '/link-institute-email/student@%s/bench-route-user' % item['domains'][0], None
+                yield 'GET', '/confirm-institute-email/missing', None
+                yield 'POST', '/confirm-institute-emails?limit=10', None
+                yield 'GET', '/update-institutions?dry_run=true&wait=true', None
+                yield 'POST', '/payment-update', {'event': 'bench'}
+                yield 'GET', '/metrics', None
+        return await self.run(requests(), concurrency=1)
+
+    async def slow_dependencies(self):
+        # Lookup traffic while Firestore and SMTP are slow enough to fill
+        # their pools. Lookups never touch either dependency, so their
+        # latency should match the plain lookup scenario.
+        db, smtp = self.main.db, FakeSMTP.backend
+        latencies = db.latency, smtp.latency
+        db.latency, smtp.latency = self.args.slow_latency, self.args.slow_latency
+        # Twice as many links as the client concurrency keep both pools busy
+        # for the whole lookup run.
+        links = self.args.concurrency * 2
+        users = db.collections.setdefault('v2_users', {})
+        for i in range(links):
+            users['slow-user-%d' % i] = {}
+        self.main.known_users.clear()
+
+        def slow_requests():
+            for i in range(links):
+                yield 'GET', '/link-institute-email/student@%s/slow-user-%d' % (
+                    self.random.choice(self.domains), i), None
+
+        try:
+            background = asyncio.ensure_future(self.run(slow_requests()))
+            await asyncio.sleep(0.1)
+            lookups = await self.run(self.lookups(self.args.requests))
+            lookups['background'] = await background
+        finally:
+            db.latency, smtp.latency = latencies
+        return lookups
+
+    async def firestore_round_trips(self):
+        # Firestore round trips per request of the link and confirm flow,
+        # counted with FakeFirestore.calls, one request at a time.
+        db = self.main.db
+        count = 50
+        users = db.collections.setdefault('v2_users', {})
+        confirmations = db.collections.setdefault('v2_institute_confirmations', {})
+        for i in range(count):
+            users['trip-user-%d' % i] = {}
+        self.main.known_users.clear()
+        round_trips = {}
+        statuses = {}
+
+        async def measure(name, requests):
+            calls = db.calls
+            result = await self.run(requests, concurrency=1)
+            round_trips[name] = round((db.calls - calls) / result['requests'], 2)
+            for status, seen in result['statuses'].items():
+                statuses[status] = statuses.get(status, 0) + seen
+
+        def links():
+            for i in range(count):
+                yield 'GET', '/link-institute-email/student@%s/trip-user-%d' % (
+                    self.random.choice(self.domains), i), None
+
+        await measure('link_institute_email', links())
+        await measure('link_institute_email_cached_user', links())
+        ids = [id for id, item in confirmations.items() if item.get('user', '').startswith('trip-user-')]
+        await measure('confirm_institute_email',
+                      (('GET', '/confirm-institute-email/' + id, None) for id in ids[:count]))
+
+        confirmations.clear()
+        # Every 50th confirmation belongs to a user that has been deleted.
+        for i in range(500):
+            confirmations['trip-confirm-%d' % i] = {
+                'user': 'trip-user-%d' % (i % count) if i % 50 else 'trip-deleted-%d' % i,
+                'email': 'student@' + self.random.choice(self.domains),
+            }
+        refused = await self.client.post('/confirm-institute-emails?limit=500', headers={'X-Admin-Token': ''})
+        statuses[str(refused.status_code)] = statuses.get(str(refused.status_code), 0) + 1
+        await measure('confirm_institute_emails_500', [('POST', '/confirm-institute-emails?limit=500', None)])
+        return {'requests': sum(statuses.values()), 'statuses': statuses, 'round_trips': round_trips}
+
+    async def coalescing(self):
+        # concurrency identical calls at once, each kind has to reach its
+        # backend exactly once.
+        main, publisher, db = self.main, self.main.api, self.main.db
+        main.catalog.listing = None
+        lists = publisher.calls
+        products = await self.run(('GET', '/get-products', None) for _ in range(self.args.concurrency))
+        lists = publisher.calls - lists
+
+        db.collections.setdefault('v2_users', {})['coalesced-user'] = {}
+        main.known_users.clear()
+        commits = db.commits
+        email = 'coalesced@' + self.random.choice(self.domains)
+        links = await self.run(('GET', '/link-institute-email/%s/coalesced-user' % email, None)
+                               for _ in range(self.args.concurrency))
+        # Emails of earlier scenarios may still be queued ahead of this one.
+        while email not in FakeSMTP.receivers:
+            await asyncio.sleep(0.05)
+        await asyncio.sleep(self.args.smtp_latency * 5)
+
+        result = dict(links, requests=products['requests'] + links['requests'])
+        result['statuses'] = {status: products['statuses'].get(status, 0) + links['statuses'].get(status, 0)
+                              for status in set(products['statuses']) | set(links['statuses'])}
+        result['upstream_calls'] = {
+            'products_list': lists,
+            'link_commits': db.commits - commits,
+            'link_emails': FakeSMTP.receivers[email],
+        }
+        result['coalesced'] = all(calls == 1 for calls in result['upstream_calls'].values())
+        return result
+
+    async def rate_limits(self):
+        # One user asking for links back to back against the default limits.
+        main = self.main
+        limits = main.link_user_limits, main.link_address_limits
+        main.link_user_limits = main.RateLimiter(5, 3600)
+        main.link_address_limits = main.RateLimiter(30, 3600)
+        main.db.collections.setdefault('v2_users', {})['limited-user'] = {}
+        domain = self.random.choice(self.domains)
+
+        def requests():
+            for _ in range(20):
+                yield 'GET', '/link-institute-email/student@%s/limited-user' % domain, None
+
+        try:
+            return await self.run(requests(), concurrency=1)
+        finally:
+            main.link_user_limits, main.link_address_limits = limits
+
+    async def institutes_sync(self):
+        # Serves a world list from a local HTTP server and syncs against it:
+        # a full sync, a conditional one, one after the file was touched but
+        # not changed, one after a record outside US/CA changed and one after
+        # a record was added.
+        directory = os.path.join(os.getcwd(), 'upstream')
+        os.makedirs(directory, exist_ok=True)
+        world = os.path.join(directory, 'world.json')
+        records = [dict(item, alpha_two_code=item.get('alpha_two_code') or 'US') for item in self.institutes]
+        records += [{'name': 'Université %d' % i, 'alpha_two_code': 'FR', 'country': 'France',
+                     'domains': ['u%d.example.fr' % i], 'web_pages': ['https://u%d.example.fr' % i]}
+                    for i in range(40000)]
+
+        def publish(records, age):
+            with open(world, 'w') as source:
+                source.write(json.dumps(records))
+            os.utime(world, (time.time() - age, time.time() - age))
+
+        publish(records, 60)
+        handler = functools.partial(QuietHandler, directory=directory)
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.main.INSTITUTES_SOURCE = 'http://127.0.0.1:%d/world.json' % server.server_port
+
+        steps = {}
+        statuses = {}
+
+        async def sync(step, url='/update-institutions?wait=true'):
+            start = time.perf_counter()
+            response = await self.client.get(url)
+            elapsed = time.perf_counter() - start
+            statuses[str(response.status_code)] = statuses.get(str(response.status_code), 0) + 1
+            steps[step] = {'ms': round(elapsed * 1000, 3), 'result': response.json()}
+
+        try:
+            await sync('initial')
+            await sync('not_modified')
+            os.utime(world, (time.time() - 30, time.time() - 30))
+            await sync('touched')
+            records[-1] = dict(records[-1], web_pages=['https://renamed.example.fr'])
+            publish(records, 20)
+            await sync('other_country')
+            publish(records + [{'name': 'Bench Sync College', 'alpha_two_code': 'US',
+                                'domains': ['sync.example.edu'], 'web_pages': []}], 0)
+            await sync('changed')
+            await sync('triggered', '/update-institutions')
+            while 'institutes-sync' in self.main.flights:
+                await asyncio.sleep(0.01)
+        finally:
+            server.shutdown()
+            server.server_close()
+        return {'requests': len(steps), 'statuses': statuses, 'steps': steps}
+
+    async def subscribers(self):
+        # --subscribers clients listen on /test-ios-ws, every payment update
+        # is timed until the last of them got it. Then all clients
+        # disconnect without another update being published, the hub must
+        # not keep their queues. CPU time is the whole process's, the fake
+        # clients included.
+        main = self.main
+        clients = [WebSocketClient(main.app, '/test-ios-ws') for _ in range(self.args.subscribers)]
+        connected = await asyncio.gather(*[client.connect() for client in clients])
+        statuses = {}
+        latencies = []
+        start = time.perf_counter()
+        cpu_start = time.process_time()
+        for i in range(self.args.requests // 10):
+            sent = time.perf_counter()
+            response = await self.client.post('/payment-update', json={'bench': i})
+            statuses[str(response.status_code)] = statuses.get(str(response.status_code), 0) + 1
+            await asyncio.gather(*[client.receive_json() for client in clients])
+            latencies.append(time.perf_counter() - sent)
+        elapsed = time.perf_counter() - start
+        cpu = time.process_time() - cpu_start
+
+        await asyncio.gather(*[client.disconnect() for client in clients])
+        latencies.sort()
+        return {
+            'requests': len(latencies),
+            'subscribers': sum(connected),
+            'seconds': round(elapsed, 4),
+            'throughput': round(len(latencies) / elapsed, 1) if elapsed else None,
+            'p50_ms': round(percentile(latencies, 50) * 1000, 3) if latencies else None,
+            'p95_ms': round(percentile(latencies, 95) * 1000, 3) if latencies else None,
+            'p99_ms': round(percentile(latencies, 99) * 1000, 3) if latencies else None,
+            'cpu_seconds': round(cpu, 4),
+            'cpu_ms_per_update': round(cpu / len(latencies) * 1000, 3) if latencies else None,
+            'statuses': statuses,
+            'subscribers_left': len(main.payments.subscribers),
+        }
+
+    async def pricing(self):
+        # pricing.to_micros_batch over --prices random prices, a few of them
+        # invalid or too large to convert. Throughput is prices per second.
+        import pricing
+        prices = []
+        for _ in range(self.args.prices):
+            roll = self.random.random()
+            if roll < 0.01:
+                prices.append(self.random.choice(['1e30', 1e30, -1.0, 'abc', float('nan')]))
+            elif roll < 0.5:
+                prices.append(round(self.random.uniform(0.99, 500), 2))
+            else:
+                prices.append('%d.%02d' % (self.random.randrange(1000), self.random.randrange(100)))
+
+        start = time.perf_counter()
+        micros, errors = pricing.to_micros_batch(prices)
+        elapsed = time.perf_counter() - start
+        return {
+            'prices': len(prices),
+            'errors': len(errors),
+            'seconds': round(elapsed, 4),
+            'throughput': round(len(prices) / elapsed, 1),
+            'ns_per_price': round(elapsed / len(prices) * 1e9, 1),
+        }
+
+    async def startup(self):
+        # Cold starts of a fresh interpreter: import main, run the startup
+        # hooks and answer one /find-institute request, the way a new
+        # gunicorn worker would. Clients of external services are not
+        # faked here.
+        # p50/p95/p99 are taken over the time from `import main` to the
+        # first response, the step timings are medians.
+        statuses = {}
+        steps = {'ready_ms': [], 'import_ms': [], 'startup_ms': [], 'first_request_ms': []}
+        for _ in range(self.args.startup_runs):
+            process = await asyncio.create_subprocess_exec(
+                sys.executable, '-c', STARTUP, ROOT, self.random.choice(self.domains),
+                stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+            output, _ = await process.communicate()
+            try:
+                result = json.loads(output.decode().splitlines()[-1])
+            except (IndexError, ValueError):
+                result = {'status': 'exit %d' % process.returncode}
+            for key in steps:
+                if key in result:
+                    steps[key].append(result[key])
+            status = str(result['status'])
+            statuses[status] = statuses.get(status, 0) + 1
+
+        ready = sorted(steps.pop('ready_ms'))
+        result = {
+            'runs': self.args.startup_runs,
+            'p50_ms': round(percentile(ready, 50), 3) if ready else None,
+            'p95_ms': round(percentile(ready, 95), 3) if ready else None,
+            'p99_ms': round(percentile(ready, 99), 3) if ready else None,
+            'statuses': statuses,
+        }
+        for key, values in steps.items():
+            result[key] = round(percentile(sorted(values), 50), 3) if values else None
+        return result
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+STARTUP = '''
+import asyncio, json, sys, time
+import httpx
+sys.path.insert(0, sys.argv[1])
+start = time.perf_counter()
+import main
+imported = time.perf_counter()
+
+
+async def boot():
+    async with main.app.router.lifespan_context(main.app):
+        started = time.perf_counter()
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://bench') as client:
+            response = await client.get('/find-institute/' + sys.argv[2])
+        return started, response.status_code
+
+started, status = asyncio.run(boot())
+ready = time.perf_counter()
+print(json.dumps({
+    'ready_ms': (ready - start) * 1000,
+    'import_ms': (imported - start) * 1000,
+    'startup_ms': (started - imported) * 1000,
+    'first_request_ms': (ready - started) * 1000,
+    'status': status,
+}))
+'''
+
+SCENARIOS = ['lookup', 'search', 'institutions', 'admin_writes', 'catalog', 'product_writes',
+             'email_links', 'every_route', 'slow_dependencies', 'firestore_round_trips', 'coalescing', 'rate_limits', 'institutes_sync',
+             'subscribers', 'pricing', 'startup']
+
+SUMMARY = ['throughput', 'p50_ms', 'p95_ms', 'p99_ms', 'import_ms', 'first_request_ms', 'statuses',
+           'upstream_calls', 'round_trips', 'steps', 'ns_per_price', 'errors',
+           'cpu_ms_per_update', 'subscribers_left']
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def prepare(workdir):
+    for name in ('institutes.json', 'data', 'firestore.json', 'credentials.json'):
+        if os.path.exists(os.path.join(ROOT, name)):
+            shutil.copy(os.path.join(ROOT, name), workdir)
+    os.chdir(workdir)
+    os.environ.setdefault('HUB_DIR', os.path.join(workdir, 'hub'))
+    os.environ.setdefault('INSTITUTES_DB', os.path.join(workdir, 'institutes.db'))
+    os.environ.pop('PROMETHEUS_MULTIPROC_DIR', None)
+    # All requests come from one client address, the rate_limits scenario
+    # puts the default limits back.
+    for name in ('LINK_EMAIL_USER_RATE_LIMIT', 'LINK_EMAIL_ADDRESS_RATE_LIMIT'):
+        os.environ.setdefault(name, '1000000000/1')
+    os.environ.setdefault('INSTITUTES_SYNC_INTERVAL', '0')
+    os.environ.setdefault('ADMIN_TOKEN', 'bench')
+    sys.path.insert(0, ROOT)
+
+
+async def run(args):
+    smtplib.SMTP = smtplib.SMTP_SSL = FakeSMTP
+    FakeSMTP.backend.latency = args.smtp_latency
+
+    import main
+    main.db = FakeFirestore(args.firestore_latency)
+    main.api = main.service = FakePublisher(latency=args.google_latency)
+    main.google_http = lambda: None
+
+    # The app logs every request it handles, only the results are printed.
+    results = {}
+    stdout = sys.stdout
+    transport = httpx.ASGITransport(app=main.app)
+    with contextlib.redirect_stdout(io.StringIO()):
+        async with main.app.router.lifespan_context(main.app):
+            async with httpx.AsyncClient(transport=transport, base_url='http://bench',
+                                         headers={'X-Admin-Token': os.environ['ADMIN_TOKEN']}) as client:
+                bench = Bench(main, client, args)
+                for scenario in args.scenarios:
+                    result = results[scenario] = await getattr(bench, scenario)()
+                    print('%-18s %s' % (scenario, '  '.join(
+                        '%s %s' % (key, result[key]) for key in SUMMARY if key in result)), file=stdout)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark main.app against fake backends.')
+    parser.add_argument('scenarios', nargs='*', help='any of %s, all by default' % ', '.join(SCENARIOS))
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--requests', type=int, default=2000, help='requests per scenario')
+    parser.add_argument('--google-latency', type=float, default=0.05)
+    parser.add_argument('--firestore-latency', type=float, default=0.02)
+    parser.add_argument('--smtp-latency', type=float, default=0.1)
+    parser.add_argument('--slow-latency', type=float, default=1.0,
+                        help='Firestore and SMTP latency in the slow_dependencies scenario')
+    parser.add_argument('--subscribers', type=int, default=1000,
+                        help='websocket clients in the subscribers scenario')
+    parser.add_argument('--prices', type=int, default=100000, help='prices converted in the pricing scenario')
+    parser.add_argument('--startup-runs', type=int, default=10, help='cold starts in the startup scenario')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=os.path.join(ROOT, 'bench_results.json'))
+    args = parser.parse_args()
+    args.scenarios = args.scenarios or SCENARIOS
+    for scenario in args.scenarios:
+        if scenario not in SCENARIOS:
+            parser.error('unknown scenario %s' % scenario)
+
+    settings = {key: value for key, value in vars(args).items() if key != 'output'}
+    workdir = tempfile.mkdtemp(prefix='kotc-bench-')
+    try:
+        prepare(workdir)
+        results = asyncio.run(run(args))
+    finally:
+        os.chdir(ROOT)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    with open(args.output, 'w') as output:
+        output.write(json.dumps({
+            'commit': git_commit(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'settings': settings,
+            'scenarios': results,
+        }, indent=2))
+    print('Results written to', args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+# Fixtures for tests that import main. main reads and writes institutes.json
+# and data in the working directory, so the session runs on copies in a
+# temporary directory, prepared the way bench.py prepares its runs, and
+# talks to the fake backends from bench.py.
+import asyncio
+import os
+import smtplib
+
+import httpx
+import pytest
+
+import bench
+
+
+@pytest.fixture(scope='session')
+def main(tmp_path_factory):
+    cwd = os.getcwd()
+    bench.prepare(str(tmp_path_factory.mktemp('kotc')))
+    import main
+    yield main
+    os.chdir(cwd)
+
+
+@pytest.fixture
+def backends(main, monkeypatch):
+    # Fresh fakes for every test, without latency.
+    db = bench.FakeFirestore()
+    publisher = bench.FakePublisher()
+    monkeypatch.setattr(main, 'db', db)
+    monkeypatch.setattr(main, 'api', publisher)
+    monkeypatch.setattr(main, 'service', publisher)
+    monkeypatch.setattr(main, 'google_http', lambda: None)
+    monkeypatch.setattr(smtplib, 'SMTP', bench.FakeSMTP)
+    monkeypatch.setattr(smtplib, 'SMTP_SSL', bench.FakeSMTP)
+    monkeypatch.setattr(bench.FakeSMTP, 'sent', 0)
+    monkeypatch.setattr(bench.FakeSMTP, 'receivers', {})
+    main.known_users.clear()
+    main.catalog.listing = None
+    main.catalog.products = None
+    return db, publisher
+
+
+@pytest.fixture
+def serve(main, backends):
+    # serve(test) runs test(client) in a new event loop, between the app's
+    # startup and shutdown hooks.
+    def serve(test):
+        async def run():
+            transport = httpx.ASGITransport(app=main.app)
+            async with main.app.router.lifespan_context(main.app):
+                async with httpx.AsyncClient(transport=transport, base_url='http://test',
+                                             headers={'X-Admin-Token': os.environ['ADMIN_TOKEN']}) as client:
+                    return await test(client)
+        return asyncio.run(run())
+    return serve
@@ -0,0 +1,18 @@
+# Picked up automatically by `gunicorn -w 4 -k uvicorn.workers.UvicornWorker main:app`
+# when started from this directory.
+import os
+import shutil
+
+from prometheus_client import multiprocess
+
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', '/tmp/kotc-metrics')
+
+
+def on_starting(server):
+    directory = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+
+
+def child_exit(server, worker):
+    multiprocess.mark_process_dead(worker.pid)
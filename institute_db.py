@@ -0,0 +1,284 @@
+import asyncio
+import json
+import sqlite3
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS institutes (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    name_lower TEXT NOT NULL,
+    alpha_two_code TEXT,
+    country TEXT,
+    is_verified INTEGER NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS institutes_name_lower ON institutes (name_lower);
+CREATE INDEX IF NOT EXISTS institutes_alpha_two_code ON institutes (alpha_two_code, country);
+CREATE INDEX IF NOT EXISTS institutes_country ON institutes (country);
+CREATE INDEX IF NOT EXISTS institutes_is_verified ON institutes (is_verified);
+
+CREATE TABLE IF NOT EXISTS domains (
+    domain TEXT NOT NULL,
+    institute_id INTEGER NOT NULL REFERENCES institutes (id) ON DELETE CASCADE
+);
+CREATE INDEX IF NOT EXISTS domains_domain ON domains (domain);
+CREATE INDEX IF NOT EXISTS domains_institute_id ON domains (institute_id);
+
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO meta (key, value) VALUES ('version', 0);
+'''
+
+
+def normalize_domain(domain):
+    return domain.rsplit('@', 1)[-1].strip().strip('.').lower()
+
+
+def domain_suffixes(domain):
+    labels = normalize_domain(domain).split('.')
+    return ['.'.join(labels[i:]) for i in range(len(labels))]
+
+
+class SqliteInstituteStore:
+    # Same interface as main.InstituteStore, backed by SQLite. Lookups and
+    # edits only touch the rows involved, opening the database does not read
+    # any institutes. Every write transaction bumps meta.version, which other
+    # workers compare in refresh() to notice changes. Writes run on a single
+    # writer thread with its own connection, so waiting for another worker's
+    # write lock and committing never block the event loop.
+
+    def __init__(self, path, on_change=None, search=None):
+        self.path = path
+        self.on_change = on_change
+        self.search = search
+        self.connection = None
+        self.writer = None
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix='institutes-db')
+        self.saving = 0
+        self.version = None
+
+    @property
+    def stat(self):
+        return None if self.version is None else (self.version,)
+
+    def connect(self):
+        connection = sqlite3.connect(self.path, isolation_level=None)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA foreign_keys=ON')
+        return connection
+
+    def load(self):
+        if self.connection is None:
+            self.connection = self.connect()
+            self.connection.executescript(SCHEMA)
+        self.version = self.current_version()
+        self.reset_search()
+
+    def current_version(self, connection=None):
+        connection = connection or self.connection
+        return connection.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()[0]
+
+    def reset_search(self):
+        if self.search is not None:
+            self.search.reset(lambda: [(row_id, json.loads(data)) for row_id, data in
+                                       self.connection.execute('SELECT id, data FROM institutes ORDER BY id')])
+
+    def rows(self, where='', params=()):
+        cursor = self.connection.execute('SELECT data FROM institutes %s ORDER BY id' % where, params)
+        return [json.loads(row[0]) for row in cursor]
+
+    def all(self):
+        return self.rows()
+
+    def find(self, domain, verified_only=True):
+        suffixes = domain_suffixes(domain)
+        row = self.connection.execute(
+            'SELECT i.data FROM domains d JOIN institutes i ON i.id = d.institute_id '
+            'WHERE d.domain IN (%s) %s ORDER BY length(d.domain) DESC, i.id LIMIT 1' % (
+                ', '.join('?' * len(suffixes)), 'AND i.is_verified = 1' if verified_only else ''),
+            suffixes).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def select(self, country=None, alpha_two_code=None):
+        clauses = []
+        params = []
+        if country is not None:
+            clauses.append('country = ?')
+            params.append(country)
+        if alpha_two_code is not None:
+            clauses.append('alpha_two_code = ?')
+            params.append(alpha_two_code)
+        return self.rows('WHERE ' + ' AND '.join(clauses) if clauses else '', params)
+
+    def row_id(self, name, ignore_case=False, connection=None):
+        # An exact match wins over one that only differs in case.
+        connection = connection or self.connection
+        rows = connection.execute(
+            'SELECT id, name FROM institutes WHERE name_lower = ? ORDER BY id', (name.lower(),)).fetchall()
+        for row_id, row_name in rows:
+            if row_name == name:
+                return row_id
+        return rows[0][0] if ignore_case and rows else None
+
+    def get(self, name, ignore_case=False):
+        row_id = self.row_id(name, ignore_case)
+        if row_id is None:
+            return None
+        row = self.connection.execute('SELECT data FROM institutes WHERE id = ?', (row_id,)).fetchone()
+        return json.loads(row[0])
+
+    def write(self, changes, item, row_id=None):
+        values = (item['name'], item['name'].lower(), item.get('alpha_two_code'), item.get('country'),
+                  1 if item.get('is_verified') else 0, json.dumps(item))
+        if row_id is None:
+            row_id = self.writer.execute(
+                'INSERT INTO institutes (name, name_lower, alpha_two_code, country, is_verified, data) '
+                'VALUES (?, ?, ?, ?, ?, ?)', values).lastrowid
+        else:
+            self.writer.execute(
+                'UPDATE institutes SET name = ?, name_lower = ?, alpha_two_code = ?, country = ?, '
+                'is_verified = ?, data = ? WHERE id = ?', values + (row_id,))
+            self.writer.execute('DELETE FROM domains WHERE institute_id = ?', (row_id,))
+        self.writer.executemany(
+            'INSERT INTO domains (domain, institute_id) VALUES (?, ?)',
+            [(domain, row_id) for domain in dict.fromkeys(normalize_domain(d) for d in item['domains'])])
+        changes.append((row_id, item))
+
+    def apply(self, changes, op, name=None, item=None):
+        if op == 'replace':
+            self.writer.execute('DELETE FROM domains')
+            self.writer.execute('DELETE FROM institutes')
+            changes.append((None, None))
+            for new_item in item:
+                self.write(changes, new_item)
+            return True
+
+        row_id = self.row_id(name, ignore_case=op == 'upsert', connection=self.writer)
+        if op == 'upsert' and row_id is None:
+            self.write(changes, item)
+            return True
+        if row_id is None:
+            return False
+
+        if op == 'delete':
+            self.writer.execute('DELETE FROM institutes WHERE id = ?', (row_id,))
+            changes.append((row_id, None))
+        else:
+            self.write(changes, item, row_id)
+        return True
+
+    def commit(self, edits):
+        # Runs on the writer thread. Returns the number of edits applied, the
+        # version they were applied on, and the changes for the search index
+        # as (row_id, item) pairs: item None for a delete, row_id None for a
+        # replace.
+        if self.writer is None:
+            self.writer = self.connect()
+        changes = []
+        self.writer.execute('BEGIN IMMEDIATE')
+        try:
+            version = self.current_version(self.writer)
+            applied = sum(1 for op, name, item in edits if self.apply(changes, op, name, item))
+            if applied:
+                self.writer.execute("UPDATE meta SET value = value + 1 WHERE key = 'version'")
+            self.writer.execute('COMMIT')
+        except BaseException:
+            self.writer.execute('ROLLBACK')
+            raise
+        return applied, version, changes
+
+    async def edit(self, edits):
+        self.saving += 1
+        try:
+            applied, version, changes = await asyncio.get_running_loop().run_in_executor(
+                self.executor, self.commit, edits)
+        finally:
+            self.saving -= 1
+        if not applied:
+            return 0
+        if version != self.version:
+            # Another worker wrote first, start over from the database.
+            self.reset_search()
+        elif self.search is not None:
+            for row_id, item in changes:
+                if row_id is None:
+                    self.reset_search()
+                    continue
+                self.search.remove(row_id)
+                if item is not None:
+                    self.search.add(row_id, item)
+        self.version = version + 1
+        self.changed()
+        return applied
+
+    async def add(self, item):
+        return await self.edit([('upsert', item['name'], item)])
+
+    async def update(self, name, item):
+        return await self.edit([('update', name, item)])
+
+    async def upsert(self, items):
+        return await self.edit([('upsert', item['name'], item) for item in items])
+
+    async def delete(self, name):
+        return await self.edit([('delete', name, None)])
+
+    async def replace(self, items):
+        return await self.edit([('replace', None, items)])
+
+    def changed(self):
+        if self.on_change is not None:
+            self.on_change()
+
+    def flush(self):
+        # Every edit is committed in its own transaction already.
+        pass
+
+    async def save(self):
+        pass
+
+    async def refresh(self):
+        # A single query, cheap enough to run on the event loop. Edits of
+        # this worker still committing set the version themselves.
+        if self.saving:
+            return False
+        version = self.current_version()
+        if version == self.version:
+            return False
+        self.version = version
+        self.reset_search()
+        self.changed()
+        return True
+
+
+def import_json(json_path, db_path):
+    with open(json_path) as source:
+        items = json.loads(source.read())
+    store = SqliteInstituteStore(db_path)
+    store.load()
+    asyncio.run(store.replace(items))
+    return len(items)
+
+
+def export_json(db_path, json_path):
+    store = SqliteInstituteStore(db_path)
+    store.load()
+    items = store.all()
+    with open(json_path, 'w') as result:
+        result.write(json.dumps(items))
+    return len(items)
+
+
+if __name__ == '__main__':
+    # python institute_db.py import institutes.json institutes.db
+    # python institute_db.py export institutes.db institutes.json
+    if len(sys.argv) != 4 or sys.argv[1] not in ('import', 'export'):
+        print('usage: institute_db.py import|export <source> <target>')
+        sys.exit(1)
+    command, source, target = sys.argv[1:]
+    count = (import_json if command == 'import' else export_json)(source, target)
+    print('%sed %d institutes' % (command, count))
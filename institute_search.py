@@ -0,0 +1,99 @@
+import heapq
+import re
+import unicodedata
+
+# Longest token prefix that gets its own index entry, longer query tokens
+# are looked up by their first MAX_PREFIX characters and then checked.
+MAX_PREFIX = 12
+
+separators = re.compile(r'[^0-9a-z]+')
+
+
+def normalize(text):
+    # 'Cégep de Saint-Jérôme' -> 'cegep de saint jerome'
+    text = unicodedata.normalize('NFKD', text)
+    text = ''.join(c for c in text if not unicodedata.combining(c)).casefold()
+    return ' '.join(separators.split(text)).strip()
+
+
+class SearchIndex:
+    # Maps every prefix of every name token to the ids of the institutes that
+    # carry it, along with the position of the first such token. Ids are the
+    # store's row ids, so edits patch single entries. After reset() the index
+    # is rebuilt from the loader on the next search, which keeps it off the
+    # startup path. Results are memoized until the next edit since typeahead
+    # traffic repeats the same short prefixes.
+
+    def __init__(self):
+        self.loader = None
+        self.entries = {}
+        self.prefixes = {}
+        self.results = {}
+
+    def reset(self, loader):
+        self.loader = loader
+        self.entries = {}
+        self.prefixes = {}
+        self.results = {}
+
+    def build(self):
+        loader, self.loader = self.loader, None
+        for row_id, item in loader():
+            self.add(row_id, item)
+
+    def add(self, row_id, item):
+        if self.loader is not None:
+            return
+        name = normalize(item['name'])
+        tokens = name.split()
+        self.entries[row_id] = (name, tokens, item)
+        self.results.clear()
+        for position, token in enumerate(tokens):
+            for i in range(1, min(len(token), MAX_PREFIX) + 1):
+                self.prefixes.setdefault(token[:i], {}).setdefault(row_id, position)
+
+    def remove(self, row_id):
+        if self.loader is not None or row_id not in self.entries:
+            return
+        _, tokens, _ = self.entries.pop(row_id)
+        self.results.clear()
+        for token in tokens:
+            for i in range(1, min(len(token), MAX_PREFIX) + 1):
+                ids = self.prefixes.get(token[:i])
+                if ids is not None and ids.pop(row_id, None) is not None and not ids:
+                    del self.prefixes[token[:i]]
+
+    def search(self, query, limit=10):
+        if self.loader is not None:
+            self.build()
+
+        query = normalize(query)
+        key = (query, limit)
+        if key in self.results:
+            return self.results[key]
+
+        terms = query.split()
+        if not terms:
+            return []
+
+        first = self.prefixes.get(terms[0][:MAX_PREFIX], {})
+        ids = first.keys()
+        for term in terms[1:]:
+            ids = ids & self.prefixes.get(term[:MAX_PREFIX], {}).keys()
+        if any(len(term) > MAX_PREFIX for term in terms):
+            ids = [row_id for row_id in ids
+                   if all(any(token.startswith(term) for token in self.entries[row_id][1]) for term in terms)]
+
+        entries = self.entries
+
+        def rank(row_id):
+            # Whole-name prefix matches first, then names where the first
+            # term matches an earlier word, then shorter names.
+            name = entries[row_id][0]
+            return not name.startswith(query), first[row_id], len(name), name
+
+        result = [entries[row_id][2] for row_id in heapq.nsmallest(limit, ids, key=rank)]
+        if len(self.results) >= 4096:
+            self.results.clear()
+        self.results[key] = result
+        return result
@@ -1,31 +1,50 @@
 # /usr/bin/python3 /usr/local/bin/gunicorn -w 4 -k uvicorn.workers.UvicornWorker main:app
-import math
+import asyncio
+import codecs
+import contextlib
+import copy
 import datetime
+import fcntl
+import functools
+import gzip
+import hashlib
+import hmac
 import json
 import os
 import smtplib
+import socket
 import ssl
+import tempfile
+import threading
+import time
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate
 from os import path
 
-import firebase_admin
+import httplib2
 import requests
 import uvicorn as uvicorn
-from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, HTTPException, Query, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from firebase_admin import credentials
-from firebase_admin import firestore
-from google.oauth2.service_account import Credentials
-from googleapiclient import discovery
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, \
+    generate_latest, multiprocess
 from pydantic import BaseModel
+from typing import List, Optional
 from fastapi.requests import Request
-from fastapi.responses import HTMLResponse
-import math
-import decimal
+from fastapi.responses import HTMLResponse, Response
+
+from institute_db import SqliteInstituteStore
+from institute_search import SearchIndex
+from pricing import PriceError, derive_prices, to_micros, to_micros_batch
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 app = FastAPI()
-IOS_PAYMENT = None
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -34,38 +53,717 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Blocking client calls (googleapiclient, Firestore, smtplib, upstream
+# downloads) run on one thread pool per dependency. The pool size caps how
+# many calls to that dependency are in flight and the timeout caps how long a
+# request waits, so one slow dependency cannot stall the event loop or
+# starve the others. Both can be overridden with e.g. SMTP_WORKERS and
+# SMTP_TIMEOUT.
+DEPENDENCIES = {
+    'google': {'workers': 8, 'timeout': 30},
+    'firestore': {'workers': 16, 'timeout': 15},
+    'smtp': {'workers': 4, 'timeout': 30},
+    'github': {'workers': 1, 'timeout': 120},
+}
+executors = {}
+
+
+async def run_blocking(dependency, fn, *args, **kwargs):
+    config = DEPENDENCIES[dependency]
+    executor = executors.get(dependency)
+    if executor is None:
+        workers = int(os.environ.get(dependency.upper() + '_WORKERS', config['workers']))
+        executor = executors[dependency] = ThreadPoolExecutor(workers, thread_name_prefix=dependency)
+
+    timeout = float(os.environ.get(dependency.upper() + '_TIMEOUT', config['timeout']))
+    call = functools.partial(timed_call, dependency, fn, *args, **kwargs)
+    future = asyncio.get_running_loop().run_in_executor(executor, call)
+    try:
+        return await asyncio.wait_for(future, timeout)
+    except asyncio.TimeoutError:
+        DEPENDENCY_ERRORS.labels(dependency, 'Timeout').inc()
+        raise
 
-def make_number(number):
-    d, w = math.modf(number)
-    dd = str(round(d, 2))[2:]
-    zeros = 6 - len(dd)
 
-    return str(w)[:-2] + dd + ('0' * zeros)
+# Set PROMETHEUS_MULTIPROC_DIR (see gunicorn.conf.py) so every gunicorn
+# worker writes its samples there and /metrics aggregates all of them.
+REQUEST_LATENCY = Histogram('kotc_request_seconds', 'HTTP request latency by route.',
+                            ['method', 'route', 'status'])
+DEPENDENCY_LATENCY = Histogram('kotc_dependency_seconds', 'Latency of blocking calls to external services.',
+                               ['dependency'])
+DEPENDENCY_ERRORS = Counter('kotc_dependency_errors_total', 'Failed calls to external services.',
+                            ['dependency', 'error'])
 
 
-cred = credentials.Certificate('firestore.json')
-firebase_admin.initialize_app(cred)
-db = firestore.client()
+def timed_call(dependency, fn, *args, **kwargs):
+    start = time.perf_counter()
+    try:
+        return fn(*args, **kwargs)
+    except Exception as e:
+        DEPENDENCY_ERRORS.labels(dependency, type(e).__name__).inc()
+        raise
+    finally:
+        DEPENDENCY_LATENCY.labels(dependency).observe(time.perf_counter() - start)
+
+
+class MetricsMiddleware:
+    # Plain ASGI middleware, BaseHTTPMiddleware costs several hundred
+    # microseconds per request on its own.
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # Label by route template so path parameters don't create new series.
+            route = scope.get('route')
+            REQUEST_LATENCY.labels(scope['method'], route.path if route is not None else 'unmatched',
+                                   str(status)).observe(time.perf_counter() - start)
+
+
+app.add_middleware(MetricsMiddleware)
+
+
+@app.get('/metrics')
+async def metrics():
+    registry = REGISTRY
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+
+
+# Firestore and the Android Publisher API are set up on first use, so a
+# worker boots from local files only and serves institute lookups even when
+# Google is unreachable. Their client libraries are imported there too, they
+# make up a good part of the import time. The discovery document is the one
+# bundled with googleapiclient.
+clients_lock = threading.RLock()
+db = None
+google_credentials = None
+service = None
+api = None
+
+
+def get_db():
+    global db
+    if db is None:
+        with clients_lock:
+            if db is None:
+                import firebase_admin
+                from firebase_admin import credentials, firestore
+                firebase_admin.initialize_app(credentials.Certificate('firestore.json'))
+                db = firestore.client()
+    return db
+
+
+def get_google_credentials():
+    global google_credentials
+    if google_credentials is None:
+        with clients_lock:
+            if google_credentials is None:
+                from google.oauth2.service_account import Credentials
+                google_credentials = Credentials.from_service_account_file(
+                    'credentials.json',
+                    scopes=['https://www.googleapis.com/auth/androidpublisher']
+                )
+    return google_credentials
+
+
+def get_service():
+    global service
+    if service is None:
+        with clients_lock:
+            if service is None:
+                from googleapiclient import discovery
+                service = discovery.build('androidpublisher', 'v3', credentials=get_google_credentials(),
+                                          static_discovery=True)
+    return service
+
+
+def get_api():
+    global api
+    if api is None:
+        with clients_lock:
+            if api is None:
+                api = get_service().inappproducts()
+    return api
+
+
+def log_warm_up_failure(task):
+    if not task.cancelled() and task.exception() is not None:
+        print('Client setup failed, retrying on first use:', task.exception())
+
+
+@app.on_event('startup')
+async def warm_up_clients():
+    # Not awaited, the worker starts serving right away. A request that needs
+    # a client before it is ready waits for clients_lock on its pool thread.
+    for dependency, get_client in (('firestore', get_db), ('google', get_api)):
+        asyncio.ensure_future(run_blocking(dependency, get_client)).add_done_callback(log_warm_up_failure)
+
+
+google_local = threading.local()
+
+
+def google_http():
+    # httplib2 connections are not thread safe, every pool thread that talks
+    # to the Android Publisher API gets its own authorized connection.
+    http = getattr(google_local, 'http', None)
+    if http is None:
+        from google_auth_httplib2 import AuthorizedHttp
+        http = google_local.http = AuthorizedHttp(get_google_credentials(), http=httplib2.Http())
+    return http
+
+
+def google_execute(build):
+    # The request is built on the google pool too, so creating the client
+    # never blocks the event loop.
+    return run_blocking('google', lambda: build().execute(http=google_http()))
+
+
+async def firestore_db():
+    # The same for Firestore: handlers only touch clients_lock from a pool
+    # thread.
+    return db if db is not None else await run_blocking('firestore', get_db)
+
+
+def file_stat(file_path):
+    try:
+        stat = os.stat(file_path)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+
+@contextlib.contextmanager
+def file_lock(file_path, blocking=True):
+    # Exclusive lock shared by every gunicorn worker on this host. With
+    # blocking=False it yields whether the lock was taken instead of waiting.
+    with open(file_path + '.lock', 'a') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def write_atomic(file_path, text):
+    directory = os.path.dirname(os.path.abspath(file_path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(file_path) + '-')
+    try:
+        with os.fdopen(fd, 'w') as result:
+            result.write(text)
+            result.flush()
+            os.fsync(result.fileno())
+        os.replace(temp_path, file_path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
 
-credentials = Credentials.from_service_account_file(
-    'credentials.json',
-    scopes=['https://www.googleapis.com/auth/androidpublisher']
-)
-api = discovery.build('androidpublisher', 'v3',
-                      credentials=credentials).inappproducts()
 
 data = {}
+data_stat = None
+
+
+def load_data():
+    global data, data_stat
+    data_stat = file_stat('data')
+    with open('data') as file:
+        data = json.loads(file.read())
+
+
+def read_data():
+    # Blocking half of a reload, safe on a pool thread.
+    with file_lock('data'):
+        with open('data') as file:
+            return file_stat('data'), json.loads(file.read())
+
 
 # Read Configurations in start
 if not path.exists('data'):
     with open('data', 'w') as _:
         _.write('{}')
 
-with open('data') as file:
-    data = json.loads(file.read())
+load_data()
 
 packageName = 'com.kingofthecurve.kingofthecurve'
 
+# Institutes are parsed once per worker and indexed by domain, every write
+# goes through the InstituteStore so the index never drifts from the file.
+# The index is a trie keyed on reversed domain labels ('edu' -> 'marywood'),
+# so a lookup for mail.cs.marywood.edu walks three labels and keeps the
+# deepest node that holds an institute.
+domain_trie = {}
+# (country, alpha_two_code) -> institutes, None matches any value.
+institute_slices = {}
+# Serialized and precompressed /institutions bodies of whole slices, replaced
+# by an empty dict on every write.
+institute_responses = {}
+institutes_modified = formatdate(usegmt=True)
+
+
+def domain_labels(domain):
+    domain = domain.rsplit('@', 1)[-1].strip().strip('.').lower()
+    return reversed(domain.split('.'))
+
+
+def invalidate_institutes(items=None):
+    global institutes_modified, institute_responses
+    institutes_modified = formatdate(usegmt=True)
+    institute_responses = {}
+
+
+def index_institutes(items):
+    global domain_trie, institute_slices
+    trie = {}
+    slices = {}
+    for item in items:
+        for domain in item['domains']:
+            node = trie
+            for label in domain_labels(domain):
+                node = node.setdefault(label, {})
+            node.setdefault('@', []).append(item)
+
+        country = item.get('country')
+        code = item['alpha_two_code']
+        # dict.fromkeys drops the repeated keys of items without a country.
+        for key in dict.fromkeys(((None, None), (country, None), (None, code), (country, code))):
+            slices.setdefault(key, []).append(item)
+    domain_trie = trie
+    institute_slices = slices
+    invalidate_institutes()
+
+
+def trie_lookup(domain, verified_only):
+    match = None
+    node = domain_trie
+    for label in domain_labels(domain):
+        node = node.get(label)
+        if node is None:
+            break
+        for item in node.get('@', ()):
+            if item['is_verified'] or not verified_only:
+                match = item
+                break
+    return match
+
+
+def lookup_institute(domain, verified_only=True):
+    # Accepts a bare domain, a subdomain or a full email address and returns
+    # the institute registered under the longest matching suffix.
+    return store.find(domain, verified_only)
+
+
+class InstituteStore:
+    # Owns institutes.json. Edits are applied in memory right away and queued,
+    # the queue is flushed after flush_delay seconds so a burst of edits turns
+    # into a single write. Flushes take an exclusive lock on <path>.lock, pick
+    # up writes made by other workers and replay the queued edits on top of
+    # them, then write a temp file and rename it over the original so readers
+    # never see a partial file. On the event loop all of that runs on a pool
+    # thread, edits whose write failed go back on the queue.
+
+    def __init__(self, path, on_change=None, search=None, flush_delay=0.5):
+        self.path = path
+        self.on_change = on_change
+        self.search = search
+        self.flush_delay = flush_delay
+        self.rows = {}
+        self.names = {}
+        self.next_id = 0
+        self.pending = []
+        self.flush_handle = None
+        self.save_lock = asyncio.Lock()
+        self.saving = False
+        self.stat = None
+
+    def load(self):
+        items = []
+        self.stat = file_stat(self.path)
+        if self.stat is not None:
+            with open(self.path) as result:
+                items = json.loads(result.read())
+        self.reset(items)
+
+    def reset(self, items):
+        if self.search is not None:
+            self.search.reset(lambda: list(self.rows.items()))
+        self.rows = {}
+        self.names = {}
+        for item in items:
+            self.insert(item)
+
+    def all(self):
+        return list(self.rows.values())
+
+    def find(self, domain, verified_only=True):
+        return trie_lookup(domain, verified_only)
+
+    def select(self, country=None, alpha_two_code=None):
+        return institute_slices.get((country, alpha_two_code), [])
+
+    def row_id(self, name, ignore_case=False):
+        # An exact match wins over one that only differs in case.
+        ids = self.names.get(name.lower(), ())
+        for row_id in ids:
+            if self.rows[row_id]['name'] == name:
+                return row_id
+        return ids[0] if ignore_case and ids else None
+
+    def get(self, name, ignore_case=False):
+        row_id = self.row_id(name, ignore_case)
+        return None if row_id is None else self.rows[row_id]
+
+    def insert(self, item, row_id=None):
+        if row_id is None:
+            row_id = self.next_id
+            self.next_id += 1
+        self.rows[row_id] = item
+        self.names.setdefault(item['name'].lower(), []).append(row_id)
+        if self.search is not None:
+            self.search.add(row_id, item)
+        return row_id
+
+    def remove(self, row_id):
+        item = self.rows[row_id]
+        ids = self.names[item['name'].lower()]
+        ids.remove(row_id)
+        if not ids:
+            del self.names[item['name'].lower()]
+        if self.search is not None:
+            self.search.remove(row_id)
+        return item
+
+    def apply(self, op, name=None, item=None):
+        if op == 'replace':
+            self.rows = {}
+            self.names = {}
+            if self.search is not None:
+                self.search.reset(lambda: list(self.rows.items()))
+            for new_item in item:
+                self.insert(new_item)
+            return True
+
+        # Upserts match names case-insensitively, like /new-institute does.
+        row_id = self.row_id(name, ignore_case=op == 'upsert')
+        if op == 'upsert' and row_id is None:
+            self.insert(item)
+            return True
+        if row_id is None:
+            return False
+
+        self.remove(row_id)
+        if op == 'delete':
+            del self.rows[row_id]
+        else:
+            self.insert(item, row_id)
+        return True
+
+    def edit(self, edits):
+        applied = []
+        for op, name, item in edits:
+            if self.apply(op, name, item):
+                applied.append((op, name, item))
+        if applied:
+            self.pending.extend(applied)
+            self.changed()
+            self.schedule_flush()
+        return len(applied)
+
+    # Coroutines like the SQLite store's, whose writes run on a thread.
+    async def add(self, item):
+        return self.edit([('upsert', item['name'], item)])
+
+    async def update(self, name, item):
+        return self.edit([('update', name, item)])
+
+    async def upsert(self, items):
+        return self.edit([('upsert', item['name'], item) for item in items])
+
+    async def delete(self, name):
+        return self.edit([('delete', name, None)])
+
+    async def replace(self, items):
+        return self.edit([('replace', None, items)])
+
+    def changed(self):
+        if self.on_change is not None:
+            self.on_change(self.all())
+
+    def schedule_flush(self):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.flush()
+            return
+        if self.flush_handle is None:
+            self.flush_handle = loop.call_later(self.flush_delay, self.start_save)
+
+    def start_save(self):
+        self.flush_handle = None
+        asyncio.ensure_future(self.save()).add_done_callback(self.log_failure)
+
+    def log_failure(self, task):
+        if not task.cancelled() and task.exception() is not None:
+            print('Unable to write', self.path, task.exception())
+
+    async def save(self):
+        async with self.save_lock:
+            if not self.pending:
+                return
+
+            pending, self.pending = self.pending, []
+            self.saving = True
+            try:
+                items, self.stat = await asyncio.get_running_loop().run_in_executor(
+                    None, self.write, pending, self.all(), self.stat)
+            except BaseException:
+                self.pending = pending + self.pending
+                self.schedule_flush()
+                raise
+            finally:
+                self.saving = False
+            if items is not None:
+                self.reload(items)
+            if self.pending:
+                self.schedule_flush()
+
+    def flush(self):
+        # Blocking save() for callers without an event loop.
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, []
+        try:
+            items, self.stat = self.write(pending, self.all(), self.stat)
+        except BaseException:
+            self.pending = pending + self.pending
+            raise
+        if items is not None:
+            self.reload(items)
+
+    def write(self, pending, items, stat):
+        # Touches no state of its own, so it can run on any thread. Returns
+        # the items written if another worker had written first, and the new
+        # file stat.
+        with file_lock(self.path):
+            merged = None
+            if file_stat(self.path) != stat:
+                other = InstituteStore(self.path)
+                other.load()
+                for op, name, item in pending:
+                    other.apply(op, name, item)
+                items = merged = other.all()
+            write_atomic(self.path, json.dumps(items))
+            return merged, file_stat(self.path)
+
+    def reload(self, items):
+        # Starts over from what was written and replays the edits queued
+        # since.
+        self.reset(items)
+        for op, name, item in self.pending:
+            self.apply(op, name, item)
+        self.changed()
+
+    async def refresh(self):
+        # Picks up writes made by other workers, the file is read on a pool
+        # thread. With edits still queued the next flush merges them instead.
+        known = self.stat
+        if self.pending or self.saving or file_stat(self.path) == known:
+            return False
+        stat, items = await asyncio.get_running_loop().run_in_executor(None, self.read)
+        if self.pending or self.saving or self.stat != known:
+            return False
+        self.reset(items)
+        self.stat = stat
+        self.changed()
+        return True
+
+    def read(self):
+        with file_lock(self.path):
+            stat = file_stat(self.path)
+            if stat is None:
+                return stat, []
+            with open(self.path) as result:
+                return stat, json.loads(result.read())
+
+
+# INSTITUTES_BACKEND=sqlite serves institutes from an indexed SQLite database
+# (see institute_db.py) instead of keeping the whole JSON list in memory.
+search_index = SearchIndex()
+if os.environ.get('INSTITUTES_BACKEND', 'json') == 'sqlite':
+    store = SqliteInstituteStore(os.environ.get('INSTITUTES_DB', 'institutes.db'),
+                                 on_change=invalidate_institutes, search=search_index)
+else:
+    store = InstituteStore('institutes.json', on_change=index_institutes, search=search_index)
+store.load()
+store.changed()
+
+# Every worker keeps its own copy of data and the institutes. Workers stat
+# both files at most once per CONFIG_RELOAD_INTERVAL seconds while serving
+# requests and reload whichever changed, which bounds how long a worker can
+# serve state another worker has already replaced.
+CONFIG_RELOAD_INTERVAL = float(os.environ.get('CONFIG_RELOAD_INTERVAL', '1'))
+config_checked = 0
+
+
+async def refresh_config():
+    global data, data_stat
+    stat = data_stat
+    if file_stat('data') != stat:
+        read = await asyncio.get_running_loop().run_in_executor(None, read_data)
+        # A write on this worker while the file was read is newer.
+        if data_stat == stat:
+            data_stat, data = read
+            # Another worker added, changed or deleted products.
+            catalog.expire()
+    await store.refresh()
+
+
+def config_version():
+    return '%d.%d' % ((data_stat or (0,))[0], (store.stat or (0,))[0])
+
+
+class ConfigMiddleware:
+    # Plain ASGI middleware like MetricsMiddleware. Reloads whatever changed
+    # before handling the request and tags the response with the versions
+    # it was served from.
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        global config_checked
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        now = time.monotonic()
+        if now - config_checked >= CONFIG_RELOAD_INTERVAL:
+            config_checked = now
+            await refresh_config()
+
+        async def send_with_version(message):
+            if message['type'] == 'http.response.start':
+                message['headers'] = [(name, value) for name, value in message.get('headers', ())
+                                      if name.lower() != b'x-config-version']
+                message['headers'].append((b'x-config-version', config_version().encode()))
+            await send(message)
+
+        await self.app(scope, receive, send_with_version)
+
+
+app.add_middleware(ConfigMiddleware)
+
+
+class SingleFlight:
+    # Collapses concurrent calls with the same key into one. The first caller
+    # starts the call, later callers wait for the same result or exception.
+    # A caller that is cancelled does not cancel the call for the others.
+
+    def __init__(self):
+        self.calls = {}
+
+    def __contains__(self, key):
+        return key in self.calls
+
+    async def run(self, key, fn, *args):
+        call = self.calls.get(key)
+        if call is None:
+            call = self.calls[key] = asyncio.ensure_future(fn(*args))
+            call.add_done_callback(functools.partial(self.done, key))
+        return await asyncio.shield(call)
+
+    def done(self, key, call):
+        if self.calls.get(key) is call:
+            del self.calls[key]
+
+
+flights = SingleFlight()
+
+
+class RateLimiter:
+    # Token bucket per key (user id, client address). A key may make `calls`
+    # calls in a burst and gets them back at a steady rate over `window`
+    # seconds. Buckets live in the worker process, they are not shared
+    # between gunicorn workers.
+
+    def __init__(self, calls, window, max_keys=10000):
+        self.calls = calls
+        self.rate = calls / window
+        self.max_keys = max_keys
+        self.buckets = {}
+
+    def tokens(self, key, now):
+        tokens, updated = self.buckets.get(key, (self.calls, now))
+        return min(self.calls, tokens + (now - updated) * self.rate)
+
+    def wait(self, key):
+        # Like take() without spending the token.
+        tokens = self.tokens(key, time.monotonic())
+        return 0 if tokens >= 1 else (1 - tokens) / self.rate
+
+    def take(self, key):
+        # Returns 0 if the call may go ahead, otherwise the seconds until the
+        # next token.
+        now = time.monotonic()
+        tokens = self.tokens(key, now)
+        if tokens < 1:
+            self.buckets[key] = (tokens, now)
+            return (1 - tokens) / self.rate
+
+        if key not in self.buckets and len(self.buckets) >= self.max_keys:
+            self.prune(now)
+        self.buckets[key] = (tokens - 1, now)
+        return 0
+
+    def prune(self, now):
+        # Refilled buckets are the same as missing ones.
+        self.buckets = {key: (tokens, updated) for key, (tokens, updated) in self.buckets.items()
+                        if tokens + (now - updated) * self.rate < self.calls}
+        if len(self.buckets) >= self.max_keys:
+            self.buckets.clear()
+
+
+def rate_limiter(name, default):
+    # '5/3600' allows bursts of 5 calls and 5 calls per hour after that. The
+    # limit holds per worker: with gunicorn -w 4 a key whose requests land
+    # on every worker gets up to 4 times as many calls.
+    calls, window = os.environ.get(name, default).split('/')
+    return RateLimiter(int(calls), float(window))
+
+
+def check_rates(*limits):
+    # Takes a token from every (limiter, key) pair, or from none of them
+    # when one is out of tokens.
+    wait = max(limiter.wait(key) for limiter, key in limits)
+    if wait:
+        raise HTTPException(status_code=429, detail='Too many requests',
+                            headers={'Retry-After': str(int(wait) + 1)})
+    for limiter, key in limits:
+        limiter.take(key)
+
+
+def client_address(request):
+    return request.client.host if request.client is not None else None
+
 
 class IAPProduct(BaseModel):
     id: str
@@ -76,209 +774,586 @@ class IAPProduct(BaseModel):
     description: str
     discountMode: bool
     subscriptionPeriod: str
+    # Optional per-region conversion, region code -> {'currency', 'rate'}.
+    rates: Optional[dict] = None
 
 
-@app.get('/get-products')
-async def get_all_products_google():
-    # new_products = []
-    product_to_be_removed = {}
-    products = api.list(packageName=packageName).execute()
+def apply_product_overlay(listing):
+    products = copy.deepcopy(listing)
+    products['inappproduct'] = [product for product in products.get('inappproduct', [])
+                                if product['sku'] != 'three_months']
     for product in products['inappproduct']:
-        if product['sku'] == 'three_months':
-            product_to_be_removed = product
-
         if product['sku'] in data:
             detail = data[product['sku']]
             discountMode = detail['discountMode']
 
             product['discount'] = detail['discount']
             if discountMode:
-                product['defaultPrice']['priceMicros'] = detail['price'] * 1000000
+                product['defaultPrice']['priceMicros'] = to_micros(detail['price'])
             product['discountMode'] = detail['discountMode']
-
-    products['inappproduct'].remove(product_to_be_removed)
     return products
 
 
-def make_number(number):
-    d, w = math.modf(number)
-    dd = str(round(d, 2))[2:]
-    zeros = 6 - len(dd)
+class ProductCatalog:
+    # Caches the Android Publisher product listing. Entries younger than ttl
+    # are served as is, entries younger than ttl + stale_ttl are served while
+    # a single background refresh runs, older ones wait for the refresh. The
+    # data overlay is applied once per listing or data change, not per request.
+    # Refreshes go through flights, so concurrent misses share one list call.
+    # Product writes patch the listing of the worker that made them, the other
+    # workers expire theirs when refresh_config sees data change.
+
+    def __init__(self, fetch, ttl, stale_ttl):
+        self.fetch = fetch
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.listing = None
+        self.products = None
+        self.overlay_stat = None
+        self.fetched_at = 0
+
+    async def get(self):
+        age = time.monotonic() - self.fetched_at
+        if self.listing is None or age >= self.ttl + self.stale_ttl:
+            await self.refresh()
+        elif age >= self.ttl and 'products' not in flights:
+            asyncio.ensure_future(self.refresh()).add_done_callback(self.log_failure)
+
+        if self.products is None or self.overlay_stat != data_stat:
+            self.overlay_stat = data_stat
+            self.products = apply_product_overlay(self.listing)
+        return self.products
+
+    async def refresh(self):
+        await flights.run('products', self.reload)
+
+    async def reload(self):
+        self.listing = await run_blocking('google', self.fetch)
+        self.products = None
+        self.fetched_at = time.monotonic()
+
+    def log_failure(self, task):
+        if not task.cancelled() and task.exception() is not None:
+            print('Product refresh failed:', task.exception())
+
+    def expire(self):
+        # The next get() waits for a fresh listing.
+        self.fetched_at = float('-inf')
+
+    def put(self, product):
+        if self.listing is None:
+            return
+        products = [item for item in self.listing.get('inappproduct', []) if item['sku'] != product['sku']]
+        products.append(product)
+        self.listing = dict(self.listing, inappproduct=products)
+        self.products = None
+
+    def remove(self, sku):
+        if self.listing is None:
+            return
+        products = [item for item in self.listing.get('inappproduct', []) if item['sku'] != sku]
+        self.listing = dict(self.listing, inappproduct=products)
+        self.products = None
+
+
+catalog = ProductCatalog(
+    lambda: get_api().list(packageName=packageName).execute(http=google_http()),
+    ttl=float(os.environ.get('PRODUCTS_TTL', '300')),
+    stale_ttl=float(os.environ.get('PRODUCTS_STALE_TTL', '3600')),
+)
 
-    return str(w)[:-2] + dd + ('0' * zeros)
+
+# Not rate limited: the listing is cached and refreshes are single-flighted,
+# so clients never reach Google directly.
+@app.get('/get-products')
+async def get_all_products_google():
+    return await catalog.get()
+
+
+def product_prices(product, price, discount):
+    # Returns the micros Google should charge and, when the product carries
+    # conversion rates, the derived regional prices.
+    micros = discount if product.discountMode else price
+    prices = derive_prices(micros, product.rates) if product.rates else None
+    return micros, prices
+
+
+def product_update_request(product, price, discount):
+    micros, prices = product_prices(product, price, discount)
+    body = {
+        'sku': product.id,
+        'status': 'active',
+        'packageName': packageName,
+        'purchaseType': product.type,
+        'defaultPrice': {
+            'priceMicros': micros,
+            'currency': 'USD'
+        },
+        'listings': {
+            'en-US': {
+                'title': product.name,
+                'description': product.description,
+            }
+        },
+        'subscriptionPeriod': product.subscriptionPeriod
+    }
+    if prices:
+        body['prices'] = prices
+    return get_api().update(packageName=packageName, sku=product.id, autoConvertMissingPrices=True, body=body)
 
 
 @app.post('/update-product')
 async def update_product(product: IAPProduct):
-    price = make_number(product.price)
-    discount = make_number(product.discount)
+    try:
+        price, discount = to_micros(product.price), to_micros(product.discount)
+        product_prices(product, price, discount)
+    except PriceError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
     try:
-        api.update(packageName=packageName, sku=product.id, autoConvertMissingPrices=True, body={
-            'sku': product.id,
-            'status': 'active',
-            'packageName': packageName,
-            'purchaseType': product.type,
-            'defaultPrice': {
-                'priceMicros': discount if product.discountMode else price,
-                'currency': 'USD'
-            },
-            'listings': {
-                'en-US': {
-                    'title': product.name,
-                    'description': product.description,
-                }
-            },
-            'subscriptionPeriod': product.subscriptionPeriod
-        }).execute()
+        result = await google_execute(lambda: product_update_request(product, price, discount))
     except Exception as e:
         print(e)
         raise HTTPException(status_code=500, detail=str(e))
-    write_product(product)
+    await write_product(product)
+    catalog.put(result)
+
+
+# SKUs per HTTP batch request, the batches themselves run in parallel on the
+# google pool.
+PRODUCT_BATCH_SIZE = 50
+
+
+def execute_product_batch(items):
+    results = {}
+
+    def callback(request_id, response, exception):
+        results[request_id] = (response, exception)
+
+    batch = get_service().new_batch_http_request(callback=callback)
+    for i, item in enumerate(items):
+        batch.add(product_update_request(*item), request_id=str(i))
+    batch.execute(http=google_http())
+    return [results.get(str(i), (None, 'No response')) for i in range(len(items))]
+
+
+@app.post('/update-products')
+async def update_products(request: Request, products: List[IAPProduct]):
+    check_admin(request)
+    # Prices and discounts are converted and validated for the whole request
+    # up front, invalid items are reported without calling Google.
+    prices, price_errors = to_micros_batch([product.price for product in products])
+    discounts, discount_errors = to_micros_batch([product.discount for product in products])
+
+    report = [None] * len(products)
+    items = []
+    for i, product in enumerate(products):
+        error = price_errors.get(i) or discount_errors.get(i)
+        if error is None:
+            try:
+                product_prices(product, prices[i], discounts[i])
+            except PriceError as e:
+                error = str(e)
+
+        if error is None:
+            items.append((i, (product, prices[i], discounts[i])))
+        else:
+            report[i] = {'sku': product.id, 'ok': False, 'error': error}
+
+    chunks = [items[i:i + PRODUCT_BATCH_SIZE] for i in range(0, len(items), PRODUCT_BATCH_SIZE)]
+    responses = await asyncio.gather(
+        *[run_blocking('google', execute_product_batch, [item for _, item in chunk]) for chunk in chunks],
+        return_exceptions=True)
+
+    updated = []
+    for chunk, results in zip(chunks, responses):
+        if isinstance(results, Exception):
+            results = [(None, results)] * len(chunk)
+        for (i, (product, _, _)), (response, exception) in zip(chunk, results):
+            if exception is not None:
+                print(exception)
+                report[i] = {'sku': product.id, 'ok': False, 'error': str(exception)}
+                continue
+            report[i] = {'sku': product.id, 'ok': True}
+            updated.append(product)
+            catalog.put(response)
+
+    if updated:
+        await write_products(updated)
+    return report
 
 
 @app.post('/new-product')
 async def new_product(product: IAPProduct):
     try:
-        api.insert(packageName=packageName, autoConvertMissingPrices=True, body={
-            'sku': product.id,
-            'status': 'active',
-            'packageName': packageName,
-            'purchaseType': product.type,
-            'defaultPrice': {
-                'priceMicros': str(int(product.price * 1000000)),
-                'currency': 'USD'
-            },
-            'listings': {
-                'en-US': {
-                    'title': product.name,
-                    'description': product.description,
-                }
+        price = to_micros(product.price)
+        prices = derive_prices(price, product.rates) if product.rates else None
+    except PriceError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    body = {
+        'sku': product.id,
+        'status': 'active',
+        'packageName': packageName,
+        'purchaseType': product.type,
+        'defaultPrice': {
+            'priceMicros': price,
+            'currency': 'USD'
+        },
+        'listings': {
+            'en-US': {
+                'title': product.name,
+                'description': product.description,
             }
-        }).execute()
+        }
+    }
+    if prices:
+        body['prices'] = prices
+
+    try:
+        result = await google_execute(
+            lambda: get_api().insert(packageName=packageName, autoConvertMissingPrices=True, body=body))
     except Exception as e:
         print(e)
         raise HTTPException(status_code=500, detail=str(e))
-    write_product(product)
+    await write_product(product)
+    catalog.put(result)
 
 
 @app.delete('/delete-product/{sku}')
 async def delete_product(sku: str):
     try:
-        api.delete(packageName=packageName, sku=sku).execute()
+        await google_execute(lambda: get_api().delete(packageName=packageName, sku=sku))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
-    write_product(sku)
+    await write_product(sku)
+    catalog.remove(sku)
+
+
+INSTITUTES_SOURCE = os.environ.get(
+    'INSTITUTES_SOURCE',
+    'https://raw.githubusercontent.com/Hipo/university-domains-list/master/world_universities_and_domains.json')
+
+
+# Upstream sync state: the ETag and Last-Modified of the last download and a
+# hash of the records it syncs, so an unchanged list is neither merged nor
+# written again.
+INSTITUTES_SYNC_STATE = os.environ.get('INSTITUTES_SYNC_STATE', 'institutes-sync.json')
+# Seconds between scheduled syncs, 0 turns the schedule off.
+INSTITUTES_SYNC_INTERVAL = float(os.environ.get('INSTITUTES_SYNC_INTERVAL', '86400'))
+SYNC_COUNTRIES = ('US', 'CA')
+
+
+def iter_json_array(chunks):
+    # Yields the items of a top level JSON array as its bytes arrive, only the
+    # undecoded tail is kept in memory.
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    started = False
+    for chunk in chunks:
+        buffer += utf8.decode(chunk)
+        position = 0
+        while True:
+            while position < len(buffer) and buffer[position] in ' \t\r\n,\ufeff':
+                position += 1
+            if position == len(buffer):
+                break
+            if not started:
+                if buffer[position] != '[':
+                    raise ValueError('Expected a JSON array')
+                started = True
+                position += 1
+                continue
+            if buffer[position] == ']':
+                return
+            try:
+                item, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                # Incomplete item, wait for the next chunk.
+                break
+            if end == len(buffer):
+                # A number cut off by the chunk boundary still decodes.
+                break
+            position = end
+            yield item
+        buffer = buffer[position:]
+    raise ValueError('Invalid or truncated JSON array')
 
 
-@app.get('/update-institutions')
-async def update_institutions_from_source():
-    new_data = json.loads(requests.get(
-        'https://raw.githubusercontent.com/Hipo/university-domains-list/master/world_universities_and_domains.json').content)
-    filtered_data = []
+def read_sync_state():
+    try:
+        with open(INSTITUTES_SYNC_STATE) as state:
+            return json.loads(state.read())
+    except (FileNotFoundError, ValueError):
+        return {}
 
-    for item in new_data:
-        code = item['alpha_two_code']
-        if code == 'US' or code == 'CA':
-            new_dict = dict(item)
-            new_dict['is_verified'] = True
-            filtered_data.append(new_dict)
-
-    if os.path.exists('institutes.json'):
-        data = []
-        with open('institutes.json') as file:
-            data = json.loads(file.read())
-
-        new_data = []
-        for item in filtered_data:
-            found = False
-            for item2 in data:
-                if item['name'] == item2['name']:
-                    found = True
-                    new_domains = []
-                    new_web_pages = []
-
-                    for domain in item['domains']:
-                        if domain not in new_domains:
-                            new_domains.append(domain)
-
-                    for web_page in item['web_pages']:
-                        if web_page not in new_web_pages:
-                            new_web_pages.append(web_page)
-
-                    for domain in item2['domains']:
-                        if domain not in new_domains:
-                            new_domains.append(domain)
-
-                    for web_page in item2['web_pages']:
-                        if web_page not in new_web_pages:
-                            new_web_pages.append(web_page)
-
-                    item2['domains'] = new_domains
-                    item2['web_pages'] = new_web_pages
-
-                    if 'is_verified' not in item2:
-                        new_item = dict(item2)
-                        new_item['is_verified'] = True
-                        new_data.append(new_item)
-                    else:
-                        new_data.append(item2)
-
-                    break
-            if not found:
-                new_data.append(item)
-
-        with open('institutes.json', 'w') as result:
-            result.write(json.dumps(new_data))
+
+def fetch_institutions_source(state):
+    # Returns the US and CA records, the new validators and a hash of those
+    # records, or None when upstream answers 304 Not Modified. Edits to other
+    # countries leave the hash as it is.
+    def filtered(chunks):
+        return [dict(item, is_verified=True) for item in iter_json_array(chunks)
+                if item.get('alpha_two_code') in SYNC_COUNTRIES]
+
+    def digest(items):
+        return hashlib.sha256(json.dumps(items, sort_keys=True).encode()).hexdigest()
+
+    if os.path.exists(INSTITUTES_SOURCE):
+        with open(INSTITUTES_SOURCE, 'rb') as source:
+            items = filtered(iter(lambda: source.read(1 << 16), b''))
+        return items, {}, digest(items)
+
+    headers = {}
+    if state.get('etag'):
+        headers['If-None-Match'] = state['etag']
+    if state.get('last_modified'):
+        headers['If-Modified-Since'] = state['last_modified']
+    with requests.get(INSTITUTES_SOURCE, headers=headers, stream=True, timeout=60) as response:
+        if response.status_code == 304:
+            return None
+        response.raise_for_status()
+        items = filtered(response.iter_content(1 << 16))
+        validators = {'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified')}
+    return items, validators, digest(items)
+
+
+def merge_institutions(filtered_data, data):
+    # Joins upstream records onto the existing ones by name. The output keeps
+    # upstream order, merged records keep their existing fields and get the
+    # union of both domain and web page lists with the upstream entries first.
+    # Existing records upstream does not list (added through the API, other
+    # countries) are kept after them.
+    existing = {}
+    for item in data:
+        existing.setdefault(item['name'], item)
+
+    summary = {'added': 0, 'updated': 0, 'unchanged': 0, 'kept': 0}
+    new_data = []
+    for item in filtered_data:
+        item2 = existing.get(item['name'])
+        if item2 is None:
+            summary['added'] += 1
+            new_data.append(item)
+            continue
+
+        new_item = dict(item2)
+        new_item['domains'] = list(dict.fromkeys(item['domains'] + item2['domains']))
+        new_item['web_pages'] = list(dict.fromkeys(item['web_pages'] + item2['web_pages']))
+        new_item.setdefault('is_verified', True)
+
+        if new_item == item2:
+            summary['unchanged'] += 1
+        else:
+            summary['updated'] += 1
+        existing[item['name']] = new_item
+        new_data.append(new_item)
+
+    upstream = {item['name'] for item in filtered_data}
+    kept = [item for item in data if item['name'] not in upstream]
+    summary['kept'] = len(kept)
+    return new_data + kept, summary
+
+
+async def sync_institutions(dry_run=False):
+    state = read_sync_state()
+    fetched = await run_blocking('github', fetch_institutions_source, state)
+    if fetched is None:
+        result = {'status': 'not_modified'}
     else:
-        with open('institutes.json', 'w') as result:
-            result.write(json.dumps(filtered_data))
+        items, validators, digest = fetched
+        if digest == state.get('hash'):
+            result = {'status': 'unchanged'}
+        else:
+            new_data, summary = merge_institutions(items, store.all())
+            # A replace rebuilds the indexes and caches of every worker, skip
+            # it when nothing would change.
+            if not dry_run and (summary['added'] or summary['updated']):
+                await store.replace(new_data)
+            result = {'status': 'dry_run' if dry_run else 'synced', 'summary': summary}
+        state = dict(state, hash=digest, **validators)
+
+    if not dry_run:
+        state['synced_at'] = time.time()
+        state['result'] = result
+        write_atomic(INSTITUTES_SYNC_STATE, json.dumps(state))
+    return result
+
+
+async def lead_sync(force=False):
+    # Only the worker holding the lock syncs, the others pick the new
+    # institutes up through store.refresh().
+    with file_lock(INSTITUTES_SYNC_STATE, blocking=False) as leader:
+        if not leader:
+            return {'status': 'running'}
+        synced_at = read_sync_state().get('synced_at', 0)
+        if not force and time.time() - synced_at < INSTITUTES_SYNC_INTERVAL:
+            return {'status': 'skipped'}
+        return await sync_institutions()
+
+
+async def schedule_syncs():
+    # Without a previous sync the first one is due a full interval after boot,
+    # a fresh deploy never syncs on its own right away.
+    booted_at = time.time()
+    while True:
+        synced_at = read_sync_state().get('synced_at', booted_at)
+        await asyncio.sleep(max(60, synced_at + INSTITUTES_SYNC_INTERVAL - time.time()))
+        try:
+            await flights.run('institutes-sync', lead_sync)
+        except Exception as e:
+            print('Institute sync failed:', e)
+            await asyncio.sleep(min(INSTITUTES_SYNC_INTERVAL, 900))
 
 
-@app.get('/institutions')
-async def get_all_institutions():
-    data = []
+sync_task = None
 
-    if os.path.exists('institutes.json'):
-        with open('institutes.json') as result:
-            data = json.loads(result.read())
-    return data
 
+@app.on_event('startup')
+async def start_syncs():
+    global sync_task
+    if INSTITUTES_SYNC_INTERVAL > 0:
+        sync_task = asyncio.ensure_future(schedule_syncs())
 
-@app.get('/find-institute/{domain}')
-async def find_institute(domain: str):
-    data = []
 
-    if os.path.exists('institutes.json'):
-        with open('institutes.json') as result:
-            data = json.loads(result.read())
+@app.on_event('shutdown')
+async def stop_syncs():
+    if sync_task is not None:
+        sync_task.cancel()
 
-    for item in data:
-        if domain in item['domains'] and item['is_verified']:
-            return item
+
+def log_sync_failure(task):
+    if not task.cancelled() and task.exception() is not None:
+        print('Institute sync failed:', task.exception())
+
+
+@app.get('/update-institutions', status_code=202)
+async def update_institutions_from_source(response: Response, dry_run: bool = False, wait: bool = False):
+    # Starts a sync and returns the result of the previous one. With wait=true
+    # it answers with the result of this one instead.
+    if dry_run:
+        call = flights.run('institutes-dry-run', sync_institutions, True)
+    else:
+        call = flights.run('institutes-sync', lead_sync, True)
+    if wait:
+        response.status_code = 200
+        return await call
+
+    asyncio.ensure_future(call).add_done_callback(log_sync_failure)
+    return {'status': 'started', 'last_sync': read_sync_state().get('result')}
+
+
+def render_institutions(items):
+    # Runs on a pool thread. Brotli's default quality 11 takes over a second
+    # on the whole list, quality 5 a few milliseconds for a slightly larger
+    # body.
+    body = json.dumps(items).encode()
+    bodies = {}
+    if brotli is not None:
+        bodies['br'] = brotli.compress(body, quality=5)
+    bodies['gzip'] = gzip.compress(body, 6)
+    bodies['identity'] = body
+    # Every encoding is a different representation and gets its own ETag.
+    digest = hashlib.md5(body).hexdigest()
+    return {
+        'etags': {encoding: '"%s"' % digest if encoding == 'identity' else '"%s-%s"' % (digest, encoding)
+                  for encoding in bodies},
+        'bodies': bodies,
+    }
+
+
+def choose_encoding(accept_encoding, encodings):
+    # Picks the encoding with the highest q-value in Accept-Encoding, ties go
+    # to the first one in encodings. Identity is acceptable unless it is
+    # ruled out, and is also what is sent when nothing else is acceptable.
+    accepted = {}
+    for part in accept_encoding.split(','):
+        coding, *params = part.split(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[coding] = q
+
+    def quality(coding):
+        if coding in accepted:
+            return accepted[coding]
+        return accepted.get('*', 1.0 if coding == 'identity' else 0.0)
+
+    best = max(encodings, key=quality)
+    return best if quality(best) > 0 else 'identity'
+
+
+async def render_slice(country, alpha_two_code):
+    # A write while rendering replaces institute_responses, the stale render
+    # then lands in the dict that was dropped.
+    responses = institute_responses
+    items = list(store.select(country, alpha_two_code))
+    cached = await asyncio.get_running_loop().run_in_executor(None, render_institutions, items)
+    if len(responses) >= 256:
+        responses.clear()
+    responses[(country, alpha_two_code)] = cached
+    return cached
+
+
+INSTITUTIONS_PAGE_SIZE = 500
+
+
+@app.get('/institutions')
+async def get_all_institutions(request: Request, country: str = None, alpha_two_code: str = None,
+                               offset: int = Query(0, ge=0),
+                               limit: Optional[int] = Query(None, ge=0, le=INSTITUTIONS_PAGE_SIZE)):
+    # Whole slices are cached, pages are rendered for every request. A page
+    # asked for without a limit holds INSTITUTIONS_PAGE_SIZE institutes.
+    if offset or limit is not None:
+        limit = INSTITUTIONS_PAGE_SIZE if limit is None else limit
+        items = store.select(country, alpha_two_code)[offset:offset + limit]
+        cached = await asyncio.get_running_loop().run_in_executor(None, render_institutions, items)
     else:
+        cached = institute_responses.get((country, alpha_two_code))
+        if cached is None:
+            cached = await flights.run(('institutions', country, alpha_two_code),
+                                       render_slice, country, alpha_two_code)
+
+    encoding = choose_encoding(request.headers.get('accept-encoding', ''), cached['bodies'])
+    headers = {
+        'ETag': cached['etags'][encoding],
+        'Last-Modified': institutes_modified,
+        'Cache-Control': 'no-cache',
+        'Vary': 'Accept-Encoding',
+    }
+    if_none_match = request.headers.get('if-none-match', '')
+    if headers['ETag'] in [tag.strip().replace('W/', '', 1) for tag in if_none_match.split(',')] \
+            or if_none_match.strip() == '*':
+        return Response(status_code=304, headers=headers)
+
+    if encoding != 'identity':
+        headers['Content-Encoding'] = encoding
+    return Response(content=cached['bodies'][encoding], media_type='application/json', headers=headers)
+
+
+@app.get('/find-institute/{domain}')
+async def find_institute(domain: str):
+    item = lookup_institute(domain)
+    if item is None:
         return {}
+    return item
 
 
-@app.get('/link-institute-email/{domain}/{id}')
-async def link_institute_email(domain: str, id: str):
-    print(id)
-    user = db.collection('v2_users').document(id)
-    user_data = user.get()
-    if user_data.exists:
-        time_now = str(datetime.datetime.utcnow())
-        db.collection('v2_institute_confirmations').document(time_now).set({
-            'user': id,
-            'email': domain,
-            'created_at': time_now
-        })
+@app.get('/search-institutes')
+async def search_institutes(q: str, limit: int = 10):
+    return search_index.search(q, max(1, min(limit, 50)))
+
 
-        port = 465
-        smtp_server = "smtp.gmail.com"
-        sender_email = "info@kingofthecurvemcatapp.com"
-        receiver_email = domain
-        password = 'Handwavy@14'
-        html = """\<!DOCTYPE html ><html xmlns="http://www.w3.org/1999/xhtml" style="width:100%;font-family:lato, 'helvetica neue', helvetica, arial, sans-serif;-webkit-text-size-adjust:100%;-ms-text-size-adjust:100%;padding:0;Margin:0"><head><meta charset="UTF-8"><meta content="width=device-width, initial-scale=1" name="viewport"><meta name="x-apple-disable-message-reformatting"><meta http-equiv="X-UA-Compatible" content="IE=edge"><meta content="telephone=no" name="format-detection"><title>KOTC-verify-account</title> <!--[if (mso 16)]><style type="text/css">     a {text-decoration: none;}     </style><![endif]--> <!--[if gte mso 9]><style>sup { font-size: 100% !important; }</style><![endif]--> <!--[if gte mso 9]><xml> <o:OfficeDocumentSettings> <o:AllowPNG></o:AllowPNG> <o:PixelsPerInch>96</o:PixelsPerInch> </o:OfficeDocumentSettings> </xml><![endif]--> <!--[if !mso]><!-- --><link href="https://fonts.googleapis.com/css?family=Lato:400,400i,700,700i" rel="stylesheet"> <!--<![endif]--><style type="text/css">#outlook a {	padding:0;}.ExternalClass {	width:100%;}.ExternalClass,.ExternalClass p,.ExternalClass span,.ExternalClass font,.ExternalClass td,.ExternalClass div {	line-height:100%;}.es-button {	mso-style-priority:100!important;	text-decoration:none!important;}a[x-apple-data-detectors] {	color:inherit!important;	text-decoration:none!important;	font-size:inherit!important;	font-family:inherit!important;	font-weight:inherit!important;	line-height:inherit!important;}.es-desk-hidden {	display:none;	float:left;	overflow:hidden;	width:0;	max-height:0;	line-height:0;	mso-hide:all;}[data-ogsb] .es-button {	border-width:0!important;	padding:15px 25px 15px 25px!important;}[data-ogsb] .es-button.es-button-1 {	padding:15px 30px!important;}@media only screen and (max-width:600px) {p, ul li, ol li, a { line-height:150%!important } h1 { font-size:30px!important; text-align:center; line-height:120%!important } h2 { font-size:26px!important; text-align:center; line-height:120%!important } h3 { font-size:20px!important; text-align:center; line-height:120%!important } .es-header-body h1 a, .es-content-body h1 a, .es-footer-body h1 a { font-size:30px!important } .es-header-body h2 a, .es-content-body h2 a, .es-footer-body h2 a { font-size:26px!important } .es-header-body h3 a, .es-content-body h3 a, .es-footer-body h3 a { font-size:20px!important } .es-menu td a { font-size:16px!important } .es-header-body p, .es-header-body ul li, .es-header-body ol li, .es-header-body a { font-size:16px!important } .es-content-body p, .es-content-body ul li, .es-content-body ol li, .es-content-body a { font-size:16px!important } .es-footer-body p, .es-footer-body ul li, .es-footer-body ol li, .es-footer-body a { font-size:16px!important } .es-infoblock p, .es-infoblock ul li, .es-infoblock ol li, .es-infoblock a { font-size:12px!important } *[class="gmail-fix"] { display:none!important } .es-m-txt-c, .es-m-txt-c h1, .es-m-txt-c h2, .es-m-txt-c h3 { text-align:center!important } .es-m-txt-r, .es-m-txt-r h1, .es-m-txt-r h2, .es-m-txt-r h3 { text-align:right!important } .es-m-txt-l, .es-m-txt-l h1, .es-m-txt-l h2, .es-m-txt-l h3 { text-align:left!important } .es-m-txt-r img, .es-m-txt-c img, .es-m-txt-l img { display:inline!important } .es-button-border { display:block!important } a.es-button, button.es-button { font-size:20px!important; display:block!important; border-width:15px 25px 15px 25px!important } .es-btn-fw { border-width:10px 0px!important; text-align:center!important } .es-adaptive table, .es-btn-fw, .es-btn-fw-brdr, .es-left, .es-right { width:100%!important } .es-content table, .es-header table, .es-footer table, .es-content, .es-footer, .es-header { width:100%!important; max-width:600px!important } .es-adapt-td { display:block!important; width:100%!important } .adapt-img { width:100%!important; height:auto!important } .es-m-p0 { padding:0px!important } .es-m-p0r { padding-right:0px!important } .es-m-p0l { padding-left:0px!important } .es-m-p0t { padding-top:0px!important } .es-m-p0b { padding-bottom:0!important } .es-m-p20b { padding-bottom:20px!important } .es-mobile-hidden, .es-hidden { display:none!important } tr.es-desk-hidden, td.es-desk-hidden, table.es-desk-hidden { width:auto!important; overflow:visible!important; float:none!important; max-height:inherit!important; line-height:inherit!important } tr.es-desk-hidden { display:table-row!important } table.es-desk-hidden { display:table!important } td.es-desk-menu-hidden { display:table-cell!important } .es-menu td { width:1%!important } table.es-table-not-adapt, .esd-block-html table { width:auto!important } table.es-social { display:inline-block!important } table.es-social td { display:inline-block!important } }</style></head>
+CONFIRM_EMAIL_HTML = """\<!DOCTYPE html ><html xmlns="http://www.w3.org/1999/xhtml" style="width:100%;font-family:lato, 'helvetica neue', helvetica, arial, sans-serif;-webkit-text-size-adjust:100%;-ms-text-size-adjust:100%;padding:0;Margin:0"><head><meta charset="UTF-8"><meta content="width=device-width, initial-scale=1" name="viewport"><meta name="x-apple-disable-message-reformatting"><meta http-equiv="X-UA-Compatible" content="IE=edge"><meta content="telephone=no" name="format-detection"><title>KOTC-verify-account</title> <!--[if (mso 16)]><style type="text/css">     a {text-decoration: none;}     </style><![endif]--> <!--[if gte mso 9]><style>sup { font-size: 100% !important; }</style><![endif]--> <!--[if gte mso 9]><xml> <o:OfficeDocumentSettings> <o:AllowPNG></o:AllowPNG> <o:PixelsPerInch>96</o:PixelsPerInch> </o:OfficeDocumentSettings> </xml><![endif]--> <!--[if !mso]><!-- --><link href="https://fonts.googleapis.com/css?family=Lato:400,400i,700,700i" rel="stylesheet"> <!--<![endif]--><style type="text/css">#outlook a {	padding:0;}.ExternalClass {	width:100%;}.ExternalClass,.ExternalClass p,.ExternalClass span,.ExternalClass font,.ExternalClass td,.ExternalClass div {	line-height:100%;}.es-button {	mso-style-priority:100!important;	text-decoration:none!important;}a[x-apple-data-detectors] {	color:inherit!important;	text-decoration:none!important;	font-size:inherit!important;	font-family:inherit!important;	font-weight:inherit!important;	line-height:inherit!important;}.es-desk-hidden {	display:none;	float:left;	overflow:hidden;	width:0;	max-height:0;	line-height:0;	mso-hide:all;}[data-ogsb] .es-button {	border-width:0!important;	padding:15px 25px 15px 25px!important;}[data-ogsb] .es-button.es-button-1 {	padding:15px 30px!important;}@media only screen and (max-width:600px) {p, ul li, ol li, a { line-height:150%!important } h1 { font-size:30px!important; text-align:center; line-height:120%!important } h2 { font-size:26px!important; text-align:center; line-height:120%!important } h3 { font-size:20px!important; text-align:center; line-height:120%!important } .es-header-body h1 a, .es-content-body h1 a, .es-footer-body h1 a { font-size:30px!important } .es-header-body h2 a, .es-content-body h2 a, .es-footer-body h2 a { font-size:26px!important } .es-header-body h3 a, .es-content-body h3 a, .es-footer-body h3 a { font-size:20px!important } .es-menu td a { font-size:16px!important } .es-header-body p, .es-header-body ul li, .es-header-body ol li, .es-header-body a { font-size:16px!important } .es-content-body p, .es-content-body ul li, .es-content-body ol li, .es-content-body a { font-size:16px!important } .es-footer-body p, .es-footer-body ul li, .es-footer-body ol li, .es-footer-body a { font-size:16px!important } .es-infoblock p, .es-infoblock ul li, .es-infoblock ol li, .es-infoblock a { font-size:12px!important } *[class="gmail-fix"] { display:none!important } .es-m-txt-c, .es-m-txt-c h1, .es-m-txt-c h2, .es-m-txt-c h3 { text-align:center!important } .es-m-txt-r, .es-m-txt-r h1, .es-m-txt-r h2, .es-m-txt-r h3 { text-align:right!important } .es-m-txt-l, .es-m-txt-l h1, .es-m-txt-l h2, .es-m-txt-l h3 { text-align:left!important } .es-m-txt-r img, .es-m-txt-c img, .es-m-txt-l img { display:inline!important } .es-button-border { display:block!important } a.es-button, button.es-button { font-size:20px!important; display:block!important; border-width:15px 25px 15px 25px!important } .es-btn-fw { border-width:10px 0px!important; text-align:center!important } .es-adaptive table, .es-btn-fw, .es-btn-fw-brdr, .es-left, .es-right { width:100%!important } .es-content table, .es-header table, .es-footer table, .es-content, .es-footer, .es-header { width:100%!important; max-width:600px!important } .es-adapt-td { display:block!important; width:100%!important } .adapt-img { width:100%!important; height:auto!important } .es-m-p0 { padding:0px!important } .es-m-p0r { padding-right:0px!important } .es-m-p0l { padding-left:0px!important } .es-m-p0t { padding-top:0px!important } .es-m-p0b { padding-bottom:0!important } .es-m-p20b { padding-bottom:20px!important } .es-mobile-hidden, .es-hidden { display:none!important } tr.es-desk-hidden, td.es-desk-hidden, table.es-desk-hidden { width:auto!important; overflow:visible!important; float:none!important; max-height:inherit!important; line-height:inherit!important } tr.es-desk-hidden { display:table-row!important } table.es-desk-hidden { display:table!important } td.es-desk-menu-hidden { display:table-cell!important } .es-menu td { width:1%!important } table.es-table-not-adapt, .esd-block-html table { width:auto!important } table.es-social { display:inline-block!important } table.es-social td { display:inline-block!important } }</style></head>
         <body style="width:100%;font-family:lato, 'helvetica neue', helvetica, arial, sans-serif;-webkit-text-size-adjust:100%;-ms-text-size-adjust:100%;padding:0;Margin:0"><div class="es-wrapper-color" style="background-color:#F4F4F4"> <v:background xmlns:v="urn:schemas-microsoft-com:vml" fill="t"> <v:fill type="tile" color="#f4f4f4"></v:fill> </v:background><![endif]--><table class="es-wrapper" width="100%" cellspacing="0" cellpadding="0" style="mso-table-lspace:0pt;mso-table-rspace:0pt;border-collapse:collapse;border-spacing:0px;padding:0;Margin:0;width:100%;height:100%;background-repeat:repeat;background-position:center top"><tr class="gmail-fix" height="0" style="border-collapse:collapse"><td style="padding:0;Margin:0"><table cellspacing="0" cellpadding="0" border="0" align="center" style="mso-table-lspace:0pt;mso-table-rspace:0pt;border-collapse:collapse;border-spacing:0px;width:600px"><tr style="border-collapse:collapse"><td cellpadding="0" cellspacing="0" border="0" style="padding:0;Margin:0;line-height:1px;min-width:600px" height="0"><img src="https://hannoq.stripocdn.email/content/guids/CABINET_837dc1d79e3a5eca5eb1609bfe9fd374/images/41521605538834349.png" style="display:block;border:0;outline:none;text-decoration:none;-ms-interpolation-mode:bicubic;max-height:0px;min-height:0px;min-width:600px;width:600px" alt width="600" height="1"></td>
         </tr></table></td>
         </tr><tr style="border-collapse:collapse; height:80px"><td valign="top" style="padding:0;Margin:0"><table class="es-content" cellspacing="0" cellpadding="0" align="center" style="mso-table-lspace:0pt;mso-table-rspace:0pt;border-collapse:collapse;border-spacing:0px;table-layout:fixed !important;width:100%"><tr style="border-collapse:collapse; height:80px"><td style="padding:0;Margin:0;background-color:#435ebe" bgcolor="#435EBE" align="center"><table class="es-content-body" style="mso-table-lspace:0pt;mso-table-rspace:0pt;border-collapse:collapse;border-spacing:0px;background-color:transparent;width:600px" cellspacing="0" cellpadding="0" align="center"><tr style="border-collapse:collapse; height:80px"><td align="left" style="padding:0;Margin:0;padding-top:20px;padding-left:30px;padding-right:30px"><table cellpadding="0" cellspacing="0" width="100%" style="mso-table-lspace:0pt;mso-table-rspace:0pt;border-collapse:collapse;border-spacing:0px"><tr style="border-collapse:collapse; height:80px"><td align="center" valign="top" style="padding:0;Margin:0;width:540px"><table cellpadding="0" cellspacing="0" width="100%" style="mso-table-lspace:0pt;mso-table-rspace:0pt;border-collapse:collapse;border-spacing:0px"><tr style="border-collapse:collapse; height:80px"><td align="center" style="padding:0;Margin:0;display:none"></td>
@@ -299,30 +1374,259 @@ async def link_institute_email(domain: str, id: str):
         </tr><tr style="border-collapse:collapse"><td class="es-m-txt-l" align="left" style="Margin:0;padding-top:20px;padding-left:30px;padding-right:30px;padding-bottom:40px"><p style="Margin:0;-webkit-text-size-adjust:none;-ms-text-size-adjust:none;mso-line-height-rule:exactly;font-family:lato, 'helvetica neue', helvetica, arial, sans-serif;line-height:27px;color:#666666;font-size:18px">Cheers,</p><p style="Margin:0;-webkit-text-size-adjust:none;-ms-text-size-adjust:none;mso-line-height-rule:exactly;font-family:lato, 'helvetica neue', helvetica, arial, sans-serif;line-height:27px;color:#666666;font-size:18px">The KingOfTheCurve Team</p></td></tr></table></td></tr></table></td></tr></table></td>
         </tr></table><table class="es-content" cellspacing="0" cellpadding="0" align="center" style="mso-table-lspace:0pt;mso-table-rspace:0pt;border-collapse:collapse;border-spacing:0px;table-layout:fixed !important;width:100%"><tr style="border-collapse:collapse"><td align="center" style="padding:0;Margin:0"><table class="es-content-body" style="mso-table-lspace:0pt;mso-table-rspace:0pt;border-collapse:collapse;border-spacing:0px;background-color:transparent;width:600px" cellspacing="0" cellpadding="0" align="center"><tr style="border-collapse:collapse"><td align="left" style="padding:0;Margin:0"><table width="100%" cellspacing="0" cellpadding="0" style="mso-table-lspace:0pt;mso-table-rspace:0pt;border-collapse:collapse;border-spacing:0px"><tr style="border-collapse:collapse"><td valign="top" align="center" style="padding:0;Margin:0;width:600px"><table style="mso-table-lspace:0pt;mso-table-rspace:0pt;border-collapse:separate;border-spacing:0px;background-color:#adbadd;border-radius:4px" width="100%" cellspacing="0" cellpadding="0" bgcolor="#adbadd" role="presentation"><tr style="border-collapse:collapse"><td align="left" style="padding:0;Margin:0"><p style="Margin:0;-webkit-text-size-adjust:none;-ms-text-size-adjust:none;mso-line-height-rule:exactly;font-family:lato, 'helvetica neue', helvetica, arial, sans-serif;line-height:27px;color:#666666;font-size:18px"><br></p>
         </td></tr></table></td></tr></table></td></tr></table></td></tr></table></td></tr></table></div></body></html>
-        """.replace('@(id)', time_now)
+        """
+
+# The template is split on its @(id) placeholder once, rendering an email is
+# a single join.
+CONFIRM_EMAIL_PARTS = CONFIRM_EMAIL_HTML.split('@(id)')
+
+SMTP_SERVER = os.environ.get('SMTP_SERVER', 'smtp.gmail.com')
+SMTP_PORT = int(os.environ.get('SMTP_PORT', '465'))
+SMTP_SSL = os.environ.get('SMTP_SSL', '1') == '1'
+SMTP_SENDER = os.environ.get('SMTP_SENDER', 'info@kingofthecurvemcatapp.com')
+SMTP_PASSWORD = os.environ.get('SMTP_PASSWORD', 'Handwavy@14')
+
+
+def render_confirm_email(receiver_email, confirmation_id):
+    message = MIMEMultipart("alternative")
+    message["Subject"] = "Confirm Institute"
+    message["From"] = SMTP_SENDER
+    message["To"] = receiver_email
+
+    part = MIMEText(confirmation_id.join(CONFIRM_EMAIL_PARTS), "html")
+
+    message.attach(part)
+    return message
+
+
+class EmailOutbox:
+    # Requests only queue their email. A single background task drains the
+    # queue in batches over one authenticated SMTP connection that is kept
+    # open between batches, failed messages are retried with exponential
+    # backoff up to max_attempts. On shutdown waiting retries are sent right
+    # away and stop() waits up to drain_timeout seconds for every queued
+    # email, their confirmations are already written.
+
+    def __init__(self, batch_size=20, max_attempts=5, backoff=2, drain_timeout=20):
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.drain_timeout = drain_timeout
+        self.queue = None
+        self.task = None
+        self.server = None
+        self.lock = threading.Lock()
+        # Emails queued, being sent or waiting for a retry.
+        self.unsent = 0
+        self.retries = {}
+        self.stopping = False
+
+    def start(self):
+        self.queue = asyncio.Queue()
+        self.task = asyncio.ensure_future(self.run())
+        self.stopping = False
+
+    async def stop(self):
+        self.stopping = True
+        for handle, item in self.retries.values():
+            handle.cancel()
+            self.queue.put_nowait(item)
+        self.retries.clear()
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.drain_timeout
+        while self.unsent and loop.time() < deadline:
+            await asyncio.sleep(0.05)
+        if self.unsent:
+            print('Error: %d emails were not sent before shutdown' % self.unsent)
+
+        if self.task is not None:
+            self.task.cancel()
+        if self.server is not None:
+            try:
+                await run_blocking('smtp', self.disconnect)
+            except Exception as e:
+                print('Error: unable to close SMTP connection', e)
+
+    def send(self, message):
+        if self.queue is None:
+            self.start()
+        self.unsent += 1
+        self.queue.put_nowait((message, 0))
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            while len(batch) < self.batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+
+            try:
+                await run_blocking('smtp', self.send_batch, batch, loop)
+            except asyncio.TimeoutError:
+                # The batch keeps going on its thread and hands back what it
+                # could not send once it is done.
+                print('Error: email batch is still sending after the SMTP timeout')
+            except Exception as e:
+                print('Error: unable to send email', e)
+
+    def finished(self, sent, failed):
+        self.unsent -= sent
+        for message, attempts in failed:
+            if attempts + 1 >= self.max_attempts:
+                print('Error: giving up on email to', message['To'])
+                self.unsent -= 1
+                continue
+            item = (message, attempts + 1)
+            if self.stopping:
+                self.queue.put_nowait(item)
+            else:
+                handle = asyncio.get_running_loop().call_later(self.backoff ** attempts, self.requeue, item)
+                self.retries[id(item)] = handle, item
+
+    def requeue(self, item):
+        del self.retries[id(item)]
+        self.queue.put_nowait(item)
+
+    def connect(self):
+        if self.server is not None:
+            try:
+                if self.server.noop()[0] == 250:
+                    return
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.close()
+
+        timeout = float(os.environ.get('SMTP_TIMEOUT', DEPENDENCIES['smtp']['timeout']))
+        if SMTP_SSL:
+            server = smtplib.SMTP_SSL(SMTP_SERVER, SMTP_PORT, timeout=timeout,
+                                      context=ssl.create_default_context())
+        else:
+            server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT, timeout=timeout)
+        if SMTP_PASSWORD:
+            server.login(SMTP_SENDER, SMTP_PASSWORD)
+        self.server = server
+
+    def close(self):
+        server, self.server = self.server, None
+        if server is not None:
+            try:
+                server.quit()
+            except (smtplib.SMTPException, OSError):
+                server.close()
+
+    def disconnect(self):
+        with self.lock:
+            self.close()
+
+    def send_batch(self, batch, loop):
+        # The lock keeps a batch that outlived its timeout from sharing the
+        # connection with the next one. Failed messages are passed back to
+        # the loop from here rather than returned, so a batch that finishes
+        # after run() stopped waiting for it is neither lost nor sent twice.
+        sent = 0
+        failed = []
+        with self.lock:
+            for i, (message, attempts) in enumerate(batch):
+                try:
+                    if i == 0 or self.server is None:
+                        self.connect()
+                    self.server.sendmail(SMTP_SENDER, message['To'], message.as_string())
+                    sent += 1
+                    print("Successfully sent email")
+                except Exception as e:
+                    print("Error: unable to send email", e)
+                    DEPENDENCY_ERRORS.labels('smtp', type(e).__name__).inc()
+                    if isinstance(e, (smtplib.SMTPServerDisconnected, OSError)):
+                        self.close()
+                    failed.append((message, attempts))
+        with contextlib.suppress(RuntimeError):
+            loop.call_soon_threadsafe(self.finished, sent, failed)
+
+
+# Keep it below gunicorn's graceful_timeout (30 seconds by default).
+outbox = EmailOutbox(drain_timeout=float(os.environ.get('OUTBOX_DRAIN_TIMEOUT', '20')))
+
+
+@app.on_event('startup')
+async def start_outbox():
+    outbox.start()
+
+
+@app.on_event('shutdown')
+async def stop_outbox():
+    await outbox.stop()
+
+
+# Only existing users are cached, a user created after a miss is picked up
+# on the next request.
+USER_CACHE_TTL = float(os.environ.get('USER_CACHE_TTL', '60'))
+known_users = {}
+
+
+async def user_exists(user):
+    expires = known_users.get(user.id)
+    if expires is not None and expires > time.monotonic():
+        return True
+
+    user_data = await run_blocking('firestore', user.get)
+    if not user_data.exists:
+        known_users.pop(user.id, None)
+        return False
+
+    if len(known_users) >= 10000:
+        known_users.clear()
+    known_users[user.id] = time.monotonic() + USER_CACHE_TTL
+    return True
+
+
+def add_confirmation_writes(db, batch, doc, doc_data):
+    user_domain = str(doc_data['email']).split('@')[1]
+
+    j = lookup_institute(user_domain, verified_only=False)
+    if j is not None:
+        batch.update(db.collection('v2_users').document(doc_data['user']), {
+            'is_institution_verification_pending': False,
+            'institute_name': j['name'],
+            "institute": j
+        })
 
-        message = MIMEMultipart("alternative")
-        message["Subject"] = "Confirm Institute"
-        message["From"] = sender_email
-        message["To"] = receiver_email
+    batch.delete(doc)
+    return j
 
-        part = MIMEText(html, "html")
 
-        message.attach(part)
+# Every link sends an email and writes a confirmation, so both the user and
+# the client address are limited. A repeated request for a link that is still
+# being sent joins it instead.
+link_user_limits = rate_limiter('LINK_EMAIL_USER_RATE_LIMIT', '5/3600')
+link_address_limits = rate_limiter('LINK_EMAIL_ADDRESS_RATE_LIMIT', '30/3600')
 
-        try:
-            context = ssl.create_default_context()
-            with smtplib.SMTP_SSL(smtp_server, port, context=context) as server:
-                server.login(sender_email, password)
-                server.sendmail(sender_email, receiver_email,
-                                message.as_string())
-            print("Successfully sent email")
-        except smtplib.SMTPException:
-            print("Error: unable to send email")
-
-        user.update({
+
+@app.get('/link-institute-email/{domain}/{id}')
+async def link_institute_email(domain: str, id: str, request: Request):
+    key = ('link-institute-email', domain, id)
+    if key not in flights:
+        check_rates((link_address_limits, client_address(request)), (link_user_limits, id))
+    return await flights.run(key, send_institute_link, domain, id)
+
+
+async def send_institute_link(domain, id):
+    print(id)
+    db = await firestore_db()
+    user = db.collection('v2_users').document(id)
+    if await user_exists(user):
+        time_now = str(datetime.datetime.utcnow())
+        batch = db.batch()
+        batch.set(db.collection('v2_institute_confirmations').document(time_now), {
+            'user': id,
+            'email': domain,
+            'created_at': time_now
+        })
+        batch.update(user, {
             'is_institution_verification_pending': True
         })
+        await run_blocking('firestore', batch.commit)
+        outbox.send(render_confirm_email(domain, time_now))
 
     # db.collection('v2_institution_verifications').add({
     #     'user': id,
@@ -338,25 +1642,13 @@ async def link_institute_email(domain: str, id: str):
 @app.get('/confirm-institute-email/{id}', response_class=HTMLResponse)
 async def confirm_institute_email(id: str):
     try:
+        db = await firestore_db()
         doc = db.collection('v2_institute_confirmations').document(id)
-        doc_data = doc.get().to_dict()
-
-        user_domain = str(doc_data['email']).split('@')[1]
-
-        f = open('institutes.json', )
-        institute_data = json.load(f)
+        doc_data = (await run_blocking('firestore', doc.get)).to_dict()
 
-        for j in institute_data:
-            if user_domain in j['domains']:
-                db.collection('v2_users').document(doc_data['user']).update({
-                    'is_institution_verification_pending': False,
-                    'institute_name': j['name'],
-                    "institute": j
-                })
-                break
-
-        doc.delete()
-        f.close()
+        batch = db.batch()
+        add_confirmation_writes(db, batch, doc, doc_data)
+        await run_blocking('firestore', batch.commit)
         return """
             <!DOCTYPE html ><html xmlns="http://www.w3.org/1999/xhtml" style="width:100%;font-family:lato, 'helvetica neue', helvetica, arial, sans-serif;-webkit-text-size-adjust:100%;-ms-text-size-adjust:100%;padding:0;Margin:0"><head><meta charset="UTF-8"><meta content="width=device-width, initial-scale=1" name="viewport"><meta name="x-apple-disable-message-reformatting"><meta http-equiv="X-UA-Compatible" content="IE=edge"><meta content="telephone=no" name="format-detection"><title>KOTC-verify-account</title> <!--[if (mso 16)]><style type="text/css">     a {text-decoration: none;}     </style><![endif]--> <!--[if gte mso 9]><style>sup { font-size: 100% !important; }</style><![endif]--> <!--[if gte mso 9]><xml> <o:OfficeDocumentSettings> <o:AllowPNG></o:AllowPNG> <o:PixelsPerInch>96</o:PixelsPerInch> </o:OfficeDocumentSettings> </xml><![endif]--> <!--[if !mso]><!-- --><link href="https://fonts.googleapis.com/css?family=Lato:400,400i,700,700i" rel="stylesheet"> <!--<![endif]--><style type="text/css">#outlook a {	padding:0;}.ExternalClass {	width:100%;}.ExternalClass,.ExternalClass p,.ExternalClass span,.ExternalClass font,.ExternalClass td,.ExternalClass div {	line-height:100%;}.es-button {	mso-style-priority:100!important;	text-decoration:none!important;}a[x-apple-data-detectors] {	color:inherit!important;	text-decoration:none!important;	font-size:inherit!important;	font-family:inherit!important;	font-weight:inherit!important;	line-height:inherit!important;}.es-desk-hidden {	display:none;	float:left;	overflow:hidden;	width:0;	max-height:0;	line-height:0;	mso-hide:all;}[data-ogsb] .es-button {	border-width:0!important;	padding:15px 25px 15px 25px!important;}[data-ogsb] .es-button.es-button-1 {	padding:15px 30px!important;}@media only screen and (max-width:600px) {p, ul li, ol li, a { line-height:150%!important } h1 { font-size:30px!important; text-align:center; line-height:120%!important } h2 { font-size:26px!important; text-align:center; line-height:120%!important } h3 { font-size:20px!important; text-align:center; line-height:120%!important } .es-header-body h1 a, .es-content-body h1 a, .es-footer-body h1 a { font-size:30px!important } .es-header-body h2 a, .es-content-body h2 a, .es-footer-body h2 a { font-size:26px!important } .es-header-body h3 a, .es-content-body h3 a, .es-footer-body h3 a { font-size:20px!important } .es-menu td a { font-size:16px!important } .es-header-body p, .es-header-body ul li, .es-header-body ol li, .es-header-body a { font-size:16px!important } .es-content-body p, .es-content-body ul li, .es-content-body ol li, .es-content-body a { font-size:16px!important } .es-footer-body p, .es-footer-body ul li, .es-footer-body ol li, .es-footer-body a { font-size:16px!important } .es-infoblock p, .es-infoblock ul li, .es-infoblock ol li, .es-infoblock a { font-size:12px!important } *[class="gmail-fix"] { display:none!important } .es-m-txt-c, .es-m-txt-c h1, .es-m-txt-c h2, .es-m-txt-c h3 { text-align:center!important } .es-m-txt-r, .es-m-txt-r h1, .es-m-txt-r h2, .es-m-txt-r h3 { text-align:right!important } .es-m-txt-l, .es-m-txt-l h1, .es-m-txt-l h2, .es-m-txt-l h3 { text-align:left!important } .es-m-txt-r img, .es-m-txt-c img, .es-m-txt-l img { display:inline!important } .es-button-border { display:block!important } a.es-button, button.es-button { font-size:20px!important; display:block!important; border-width:15px 25px 15px 25px!important } .es-btn-fw { border-width:10px 0px!important; text-align:center!important } .es-adaptive table, .es-btn-fw, .es-btn-fw-brdr, .es-left, .es-right { width:100%!important } .es-content table, .es-header table, .es-footer table, .es-content, .es-footer, .es-header { width:100%!important; max-width:600px!important } .es-adapt-td { display:block!important; width:100%!important } .adapt-img { width:100%!important; height:auto!important } .es-m-p0 { padding:0px!important } .es-m-p0r { padding-right:0px!important } .es-m-p0l { padding-left:0px!important } .es-m-p0t { padding-top:0px!important } .es-m-p0b { padding-bottom:0!important } .es-m-p20b { padding-bottom:20px!important } .es-mobile-hidden, .es-hidden { display:none!important } tr.es-desk-hidden, td.es-desk-hidden, table.es-desk-hidden { width:auto!important; overflow:visible!important; float:none!important; max-height:inherit!important; line-height:inherit!important } tr.es-desk-hidden { display:table-row!important } table.es-desk-hidden { display:table!important } td.es-desk-menu-hidden { display:table-cell!important } .es-menu td { width:1%!important } table.es-table-not-adapt, .esd-block-html table { width:auto!important } table.es-social { display:inline-block!important } table.es-social td { display:inline-block!important } }</style></head>
             <body style="width:100%;font-family:lato, 'helvetica neue', helvetica, arial, sans-serif;-webkit-text-size-adjust:100%;-ms-text-size-adjust:100%;padding:0;Margin:0"><div class="es-wrapper-color" style="background-color:#F4F4F4"> <v:background xmlns:v="urn:schemas-microsoft-com:vml" fill="t"> <v:fill type="tile" color="#f4f4f4"></v:fill> </v:background><![endif]--><table class="es-wrapper" width="100%" cellspacing="0" cellpadding="0" style="mso-table-lspace:0pt;mso-table-rspace:0pt;border-collapse:collapse;border-spacing:0px;padding:0;Margin:0;width:100%;height:100%;background-repeat:repeat;background-position:center top"><tr class="gmail-fix" height="0" style="border-collapse:collapse"><td style="padding:0;Margin:0"><table cellspacing="0" cellpadding="0" border="0" align="center" style="mso-table-lspace:0pt;mso-table-rspace:0pt;border-collapse:collapse;border-spacing:0px;width:600px"><tr style="border-collapse:collapse"><td cellpadding="0" cellspacing="0" border="0" style="padding:0;Margin:0;line-height:1px;min-width:600px" height="0"><img src="https://hannoq.stripocdn.email/content/guids/CABINET_837dc1d79e3a5eca5eb1609bfe9fd374/images/41521605538834349.png" style="display:block;border:0;outline:none;text-decoration:none;-ms-interpolation-mode:bicubic;max-height:0px;min-height:0px;min-width:600px;width:600px" alt width="600" height="1"></td>
@@ -388,6 +1680,60 @@ async def confirm_institute_email(id: str):
             """
 
 
+# Shared secret for admin endpoints, sent as the X-Admin-Token header. They
+# are refused while it is not set.
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN', '')
+
+
+def check_admin(request):
+    token = request.headers.get('X-Admin-Token', '')
+    if not ADMIN_TOKEN or not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail='Forbidden')
+
+
+@app.post('/confirm-institute-emails')
+async def confirm_institute_emails(request: Request, limit: int = 500):
+    # Admin backfill: confirms pending requests in bulk, 250 per batched
+    # commit (an update and a delete each, within Firestore's 500 writes).
+    # Requests with an unusable email or a deleted user can never be
+    # confirmed and are removed. Confirming skips the emailed link, so only
+    # admins may call this.
+    check_admin(request)
+    db = await firestore_db()
+    docs = await run_blocking('firestore', db.collection('v2_institute_confirmations').limit(limit).get)
+    summary = {'confirmed': 0, 'unmatched': 0, 'invalid': 0, 'batches': 0}
+
+    for start in range(0, len(docs), 250):
+        chunk = [(snapshot, snapshot.to_dict()) for snapshot in docs[start:start + 250]]
+        # An update of a deleted user fails the whole commit with NOT_FOUND,
+        # so the users of the batch are looked up first, in one call.
+        users = {}
+        for snapshot, doc_data in chunk:
+            with contextlib.suppress(KeyError, TypeError, ValueError):
+                users[doc_data['user']] = db.collection('v2_users').document(doc_data['user'])
+        if users:
+            existing = await run_blocking('firestore', lambda: {
+                user.id for user in db.get_all(list(users.values())) if user.exists})
+        else:
+            existing = set()
+
+        batch = db.batch()
+        for snapshot, doc_data in chunk:
+            try:
+                if doc_data['user'] not in existing:
+                    raise KeyError(doc_data['user'])
+                j = add_confirmation_writes(db, batch, snapshot.reference, doc_data)
+            except (IndexError, KeyError, TypeError):
+                batch.delete(snapshot.reference)
+                summary['invalid'] += 1
+                continue
+            summary['confirmed' if j is not None else 'unmatched'] += 1
+
+        await run_blocking('firestore', batch.commit)
+        summary['batches'] += 1
+    return summary
+
+
 class Institute(BaseModel):
     name: str
     domains: list
@@ -407,52 +1753,161 @@ class Institute(BaseModel):
 
 @app.post('/new-institute')
 async def new_institute(institute: Institute):
-    data = await get_all_institutions()
-
-    for i in range(len(data)):
-        if data[i]['name'].lower() == institute.name.lower():
-            return {}
+    if store.get(institute.name, ignore_case=True) is not None:
+        return {}
 
-    data.append(institute.to_dict())
-    with open('institutes.json', 'w') as result:
-        result.write(json.dumps(data))
+    await store.add(institute.to_dict())
 
 
 @app.post('/update-institute/{name}')
 async def update_institute(name: str, institute: Institute):
-    index = -1
-    data = await get_all_institutions()
+    if store.get(name) is not None:
+        print(institute.to_dict())
+        await store.update(name, institute.to_dict())
+
+
+@app.post('/upsert-institutes')
+async def upsert_institutes(request: Request, items: List[Institute]):
+    check_admin(request)
+    updated = sum(1 for item in items if store.get(item.name, ignore_case=True) is not None)
+    await store.upsert([item.to_dict() for item in items])
+    return {'added': len(items) - updated, 'updated': updated}
+
+
+@app.on_event('shutdown')
+async def flush_institutes():
+    await store.save()
+
+
+class NotificationHub:
+    # Fans payment updates out to websocket subscribers. Every subscriber has
+    # a bounded queue and is evicted when it falls queue_size messages
+    # behind, so a slow client never holds up the publisher. Updates are
+    # also forwarded to the other workers over unix datagram sockets, one
+    # socket per worker in directory.
+
+    def __init__(self, directory, queue_size=32):
+        self.directory = directory
+        self.queue_size = queue_size
+        self.subscribers = set()
+        self.sock = None
+        self.sock_path = None
+
+    def subscribe(self):
+        queue = asyncio.Queue(self.queue_size)
+        self.subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        self.subscribers.discard(queue)
+
+    def deliver(self, message):
+        for queue in list(self.subscribers):
+            try:
+                queue.put_nowait(message)
+            except asyncio.QueueFull:
+                self.evict(queue)
+
+    def evict(self, queue, marker=None):
+        # Replaces the backlog with marker so the subscriber wakes up, None
+        # makes it close its websocket.
+        self.subscribers.discard(queue)
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait(marker)
+
+    def publish(self, message):
+        self.deliver(message)
+        if self.sock is None:
+            return
+
+        payload = json.dumps(message).encode()
+        for name in os.listdir(self.directory):
+            peer = os.path.join(self.directory, name)
+            if peer == self.sock_path or not name.endswith('.sock'):
+                continue
+            try:
+                self.sock.sendto(payload, peer)
+            except (ConnectionRefusedError, FileNotFoundError):
+                # Left behind by a worker that exited without cleaning up.
+                with contextlib.suppress(OSError):
+                    os.unlink(peer)
+            except OSError as e:
+                print('Unable to forward payment update', peer, e)
+
+    def receive(self):
+        while True:
+            try:
+                payload = self.sock.recv(1 << 18)
+            except BlockingIOError:
+                return
+            self.deliver(json.loads(payload))
 
-    for i in range(len(data)):
-        if data[i]['name'] == name:
-            index = i
-            break
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.sock_path = os.path.join(self.directory, '%d.sock' % os.getpid())
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(self.sock_path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(self.sock_path)
+        self.sock.setblocking(False)
+        asyncio.get_running_loop().add_reader(self.sock.fileno(), self.receive)
+
+    def stop(self):
+        if self.sock is None:
+            return
+        asyncio.get_running_loop().remove_reader(self.sock.fileno())
+        self.sock.close()
+        self.sock = None
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(self.sock_path)
+
+
+payments = NotificationHub(os.environ.get('HUB_DIR', os.path.join(tempfile.gettempdir(), 'kotc-hub')))
+
+
+@app.on_event('startup')
+async def start_payments():
+    payments.start()
 
-    if index != -1:
-        print(institute.to_dict())
-        data[index] = institute.to_dict()
 
-        with open('institutes.json', 'w') as result:
-            result.write(json.dumps(data))
+@app.on_event('shutdown')
+async def stop_payments():
+    payments.stop()
 
 
 @app.post('/payment-update')
 async def payment_updated(request: Request):
-    IOS_PAYMENT = await request.json()
+    payments.publish(await request.json())
 
 
 @app.websocket('/test-ios-ws')
 async def connect_to_ios(websocket: WebSocket):
-    global IOS_PAYMENT
     await websocket.accept()
+    queue = payments.subscribe()
+
+    async def watch():
+        # Clients never send anything, the socket is read so a disconnect
+        # drops the queue right away instead of on the next update.
+        while (await websocket.receive())['type'] != 'websocket.disconnect':
+            pass
+        payments.evict(queue, WebSocketDisconnect())
+
+    watcher = asyncio.ensure_future(watch())
     try:
         while True:
-            if IOS_PAYMENT is None:
-                continue
-            await websocket.send(IOS_PAYMENT)
-            IOS_PAYMENT = None
+            payment = await queue.get()
+            if payment is None:
+                await websocket.close(code=1013)
+                break
+            if isinstance(payment, WebSocketDisconnect):
+                raise payment
+            await websocket.send_json(payment)
     except WebSocketDisconnect:
         print('Websocket client disconnected')
+    finally:
+        payments.unsubscribe(queue)
+        watcher.cancel()
 
 
 # @app.websocket('/test-android-ws')
@@ -471,32 +1926,42 @@ async def connect_to_ios(websocket: WebSocket):
 
 @app.post('/delete-institute/{name}')
 async def delete_institute(name: str):
-    item = None
-    data = await get_all_institutions()
+    await store.delete(name)
 
-    for i in data:
-        if i['name'] == name:
-            item = i
-            break
-    data.remove(i)
 
-    with open('institutes.json', 'w') as result:
-        result.write(json.dumps(data))
+async def write_product(product):
+    await write_products([product])
+
+
+# Writes of this worker run one at a time, so the last one to finish is the
+# newest.
+data_lock = asyncio.Lock()
+
 
+async def write_products(products):
+    global data, data_stat
+    async with data_lock:
+        data_stat, data = await asyncio.get_running_loop().run_in_executor(
+            None, write_data, products, data, data_stat)
 
-def write_product(product):
-    if type(product) == 'str':
-        if product in data:
-            del data[product]
-        return
 
-    if product.id not in data or data[product.id] is None:
-        data[product.id] = {}
+def write_data(products, current, stat):
+    # Blocking half of write_products, safe on a pool thread: the products are
+    # applied to a copy, or to the file if another worker wrote it since.
+    with file_lock('data'):
+        if file_stat('data') != stat:
+            with open('data') as file:
+                current = json.loads(file.read())
+        current = dict(current)
 
-    data[product.id] = {'price': product.price,
-                        'discount': product.discount, 'discountMode': product.discountMode}
-    with open('data', 'w') as output_file:
-        output_file.write(json.dumps(data))
+        for product in products:
+            if isinstance(product, str):
+                current.pop(product, None)
+            else:
+                current[product.id] = {'price': product.price,
+                                       'discount': product.discount, 'discountMode': product.discountMode}
+        write_atomic('data', json.dumps(current))
+        return file_stat('data'), current
 
 
 if __name__ == '__main__':
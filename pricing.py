@@ -0,0 +1,79 @@
+import decimal
+from decimal import Decimal
+
+MICROS = Decimal(1000000)
+CENT = Decimal('0.01')
+UNIT = Decimal(1)
+
+# Currencies Google Play prices in whole units.
+ZERO_DECIMAL_CURRENCIES = {'BIF', 'CLP', 'COP', 'HUF', 'IDR', 'JPY', 'KRW', 'PYG', 'TWD', 'UGX', 'VND'}
+
+context = decimal.Context(prec=28, rounding=decimal.ROUND_HALF_UP, traps=[decimal.InvalidOperation])
+
+
+class PriceError(ValueError):
+    pass
+
+
+def to_decimal(price):
+    # repr() of a float is the shortest string that round trips, so 19.99
+    # becomes Decimal('19.99') rather than 19.989999999999998...
+    if isinstance(price, float):
+        price = repr(price)
+    try:
+        value = context.create_decimal(price)
+    except (decimal.InvalidOperation, TypeError, ValueError):
+        raise PriceError('Invalid price: %r' % (price,))
+    if not value.is_finite() or value < 0:
+        raise PriceError('Invalid price: %r' % (price,))
+    return value
+
+
+def to_micros(price, quantum=CENT):
+    try:
+        value = to_decimal(price).quantize(quantum, context=context)
+    except decimal.InvalidOperation:
+        # More digits than the context holds, e.g. 1e30.
+        raise PriceError('Invalid price: %r' % (price,))
+    return str(int(value * MICROS))
+
+
+def from_micros(micros):
+    return context.divide(Decimal(int(micros)), MICROS)
+
+
+def to_micros_batch(prices, quantum=CENT):
+    # Converts every price in one pass. Invalid entries come back as None in
+    # micros and are listed in errors by index, so callers can report all of
+    # them at once.
+    micros = []
+    errors = {}
+    for i, price in enumerate(prices):
+        try:
+            micros.append(to_micros(price, quantum))
+        except PriceError as e:
+            micros.append(None)
+            errors[i] = str(e)
+    return micros, errors
+
+
+def derive_prices(price_micros, rates):
+    # rates maps a Play region code to {'currency': 'EUR', 'rate': 0.92}. The
+    # converted price is rounded to the currency's smallest unit and returned
+    # in the shape the Publisher API expects for InAppProduct.prices.
+    price = from_micros(price_micros)
+    prices = {}
+    for region, rate in rates.items():
+        try:
+            currency = str(rate['currency']).upper()
+            multiplier = to_decimal(rate['rate'])
+        except (KeyError, TypeError):
+            raise PriceError('Invalid rate for %s: %r' % (region, rate))
+
+        quantum = UNIT if currency in ZERO_DECIMAL_CURRENCIES else CENT
+        converted = context.multiply(price, multiplier)
+        prices[region] = {
+            'priceMicros': to_micros(converted, quantum),
+            'currency': currency,
+        }
+    return prices
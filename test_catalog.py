@@ -0,0 +1,146 @@
+# python -m pytest test_catalog.py
+#
+# The /get-products cache against the fake inappproducts() resource from
+# bench.py.
+import asyncio
+import json
+import time
+
+
+def product(sku, price=4.99):
+    return {'id': sku, 'name': 'Test product', 'type': 'managedUser', 'price': price, 'discount': 0.99,
+            'description': 'Test product', 'discountMode': False, 'subscriptionPeriod': ''}
+
+
+def skus(response):
+    return {item['sku'] for item in response.json()['inappproduct']}
+
+
+def lists(publisher, monkeypatch):
+    # Counts list() calls only, writes are round trips of the publisher too.
+    calls = []
+    original = publisher.list
+
+    def list_products(packageName):
+        calls.append(packageName)
+        return original(packageName)
+
+    monkeypatch.setattr(publisher, 'list', list_products)
+    return calls
+
+
+def test_one_listing_per_ttl(main, serve, backends, monkeypatch):
+    db, publisher = backends
+    calls = lists(publisher, monkeypatch)
+
+    async def test(client):
+        for _ in range(20):
+            assert (await client.get('/get-products')).status_code == 200
+        assert len(calls) == 1
+
+        main.catalog.fetched_at -= main.catalog.ttl
+        for _ in range(20):
+            await client.get('/get-products')
+        # Lets the background refresh start.
+        await asyncio.sleep(0)
+        while 'products' in main.flights:
+            await asyncio.sleep(0.01)
+        await client.get('/get-products')
+        assert len(calls) == 2
+
+    serve(test)
+
+
+def test_stale_listing_is_served_while_it_refreshes(main, serve, backends):
+    db, publisher = backends
+
+    async def test(client):
+        before = skus(await client.get('/get-products'))
+        publisher.products['added_upstream'] = dict(publisher.products['bench_product_0'], sku='added_upstream')
+        publisher.latency = 0.2
+        main.catalog.fetched_at -= main.catalog.ttl
+
+        start = time.perf_counter()
+        assert skus(await client.get('/get-products')) == before
+        assert time.perf_counter() - start < 0.1
+        await asyncio.sleep(0)
+        assert 'products' in main.flights
+
+        while 'products' in main.flights:
+            await asyncio.sleep(0.01)
+        assert 'added_upstream' in skus(await client.get('/get-products'))
+
+    serve(test)
+
+
+def test_expired_listing_waits_for_the_refresh(main, serve, backends):
+    db, publisher = backends
+
+    async def test(client):
+        await client.get('/get-products')
+        publisher.products['added_upstream'] = dict(publisher.products['bench_product_0'], sku='added_upstream')
+        main.catalog.fetched_at -= main.catalog.ttl + main.catalog.stale_ttl
+        assert 'added_upstream' in skus(await client.get('/get-products'))
+
+    serve(test)
+
+
+def test_writes_patch_the_listing(main, serve, backends, monkeypatch):
+    db, publisher = backends
+    calls = lists(publisher, monkeypatch)
+
+    async def test(client):
+        await client.get('/get-products')
+        assert (await client.post('/new-product', json=product('test_new'))).status_code == 200
+        assert 'test_new' in skus(await client.get('/get-products'))
+        with open('data') as source:
+            assert json.loads(source.read())['test_new'] == main.data['test_new']
+
+        assert (await client.post('/update-product', json=product('test_new', 9.99))).status_code == 200
+        listed = {item['sku']: item for item in (await client.get('/get-products')).json()['inappproduct']}
+        assert listed['test_new']['defaultPrice']['priceMicros'] == '9990000'
+
+        assert (await client.delete('/delete-product/test_new')).status_code == 200
+        assert 'test_new' not in skus(await client.get('/get-products'))
+        assert 'test_new' not in main.data
+
+    serve(test)
+    assert len(calls) == 1
+
+
+def test_data_written_by_another_worker_expires_the_listing(main, serve, backends, monkeypatch):
+    db, publisher = backends
+    calls = lists(publisher, monkeypatch)
+    monkeypatch.setattr(main, 'CONFIG_RELOAD_INTERVAL', 0)
+
+    async def test(client):
+        await client.get('/get-products')
+        await client.get('/get-products')
+        assert len(calls) == 1
+
+        # What another worker's /delete-product leaves behind.
+        del publisher.products['bench_product_1']
+        with open('data') as source:
+            data = json.loads(source.read())
+        data['from_another_worker'] = {'price': 1.99, 'discount': 0.99, 'discountMode': False}
+        main.write_atomic('data', json.dumps(data))
+
+        assert 'bench_product_1' not in skus(await client.get('/get-products'))
+        assert len(calls) == 2
+
+    serve(test)
+
+
+def test_bulk_updates_need_the_admin_token(main, serve, backends):
+    db, publisher = backends
+
+    async def test(client):
+        products = [product('bench_product_0', 9.99), product('bench_product_1', 9.99)]
+        refused = await client.post('/update-products', json=products, headers={'X-Admin-Token': 'wrong'})
+        assert refused.status_code == 403
+        assert publisher.calls == 0
+
+        response = await client.post('/update-products', json=products)
+        assert [item['ok'] for item in response.json()] == [True, True]
+
+    serve(test)
@@ -0,0 +1,133 @@
+# python -m pytest test_coalescing.py
+#
+# SingleFlight, the rate limiters and the routes that use them.
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+import bench
+
+CALLS = 50
+
+
+def test_concurrent_calls_share_one_call(main):
+    flights = main.SingleFlight()
+    started = []
+
+    async def fetch(value):
+        started.append(value)
+        await asyncio.sleep(0.01)
+        return value
+
+    async def run():
+        return await asyncio.gather(*[flights.run('key', fetch, i) for i in range(CALLS)])
+
+    assert asyncio.run(run()) == [0] * CALLS
+    assert started == [0]
+    assert 'key' not in flights
+
+
+def test_failures_reach_every_caller_and_are_not_kept(main):
+    flights = main.SingleFlight()
+    started = []
+
+    async def fail():
+        started.append(None)
+        await asyncio.sleep(0.01)
+        raise ValueError('upstream down')
+
+    async def run():
+        results = await asyncio.gather(*[flights.run('key', fail) for _ in range(CALLS)],
+                                       return_exceptions=True)
+        await flights.run('key', asyncio.sleep, 0)
+        return results
+
+    results = asyncio.run(run())
+    assert len(started) == 1
+    assert all(isinstance(result, ValueError) for result in results)
+
+
+def test_a_cancelled_caller_leaves_the_call_running(main):
+    flights = main.SingleFlight()
+
+    async def run():
+        first = asyncio.ensure_future(flights.run('key', asyncio.sleep, 0.02, 'done'))
+        second = asyncio.ensure_future(flights.run('key', asyncio.sleep, 0.02, 'other'))
+        await asyncio.sleep(0)
+        first.cancel()
+        return await second
+
+    assert asyncio.run(run()) == 'done'
+
+
+def test_rate_limiter_allows_a_burst_then_refills(main, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(main.time, 'monotonic', lambda: now[0])
+    limiter = main.RateLimiter(3, 60)
+
+    assert [limiter.take('user') for _ in range(3)] == [0, 0, 0]
+    assert limiter.take('user') == pytest.approx(20)
+    assert limiter.take('other') == 0
+
+    now[0] += 20
+    assert limiter.wait('user') == 0
+    assert limiter.wait('user') == 0
+    assert limiter.take('user') == 0
+    assert limiter.take('user') == pytest.approx(20)
+
+
+def test_rate_limiter_prunes_refilled_buckets(main, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(main.time, 'monotonic', lambda: now[0])
+    limiter = main.RateLimiter(1, 1, max_keys=10)
+    for i in range(10):
+        limiter.take(i)
+    now[0] += 2
+    limiter.take('new')
+    assert list(limiter.buckets) == ['new']
+
+
+def test_check_rates_spends_all_tokens_or_none(main):
+    addresses = main.RateLimiter(5, 3600)
+    users = main.RateLimiter(1, 3600)
+
+    main.check_rates((addresses, 'ip'), (users, 'user'))
+    for _ in range(3):
+        with pytest.raises(HTTPException) as refused:
+            main.check_rates((addresses, 'ip'), (users, 'user'))
+        assert refused.value.status_code == 429
+        assert refused.value.headers['Retry-After'] == '3600'
+
+    assert addresses.wait('ip') == 0
+    assert addresses.buckets['ip'][0] == pytest.approx(4)
+
+
+def test_concurrent_product_listings_reach_google_once(serve, backends):
+    db, publisher = backends
+
+    async def test(client):
+        return await asyncio.gather(*[client.get('/get-products') for _ in range(CALLS)])
+
+    responses = serve(test)
+    assert {response.status_code for response in responses} == {200}
+    assert publisher.calls == 1
+
+
+def test_concurrent_identical_links_send_one_email(main, serve, backends):
+    db, publisher = backends
+    db.collections['v2_users'] = {'user-1': {}}
+    domain = main.store.all()[0]['domains'][0]
+    email = 'student@' + domain
+
+    async def test(client):
+        responses = await asyncio.gather(*[client.get('/link-institute-email/%s/user-1' % email)
+                                           for _ in range(CALLS)])
+        while email not in bench.FakeSMTP.receivers:
+            await asyncio.sleep(0.01)
+        return responses
+
+    responses = serve(test)
+    assert {response.status_code for response in responses} == {200}
+    assert db.commits == 1
+    assert bench.FakeSMTP.receivers == {email: 1}
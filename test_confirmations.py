@@ -0,0 +1,117 @@
+# python -m pytest test_confirmations.py
+#
+# Firestore round trips of the link and confirm flow, against the in-process
+# FakeFirestore from bench.py.
+import smtplib
+import time
+
+import bench
+
+
+def institute_email(main, i=0):
+    return 'student@' + main.store.all()[i]['domains'][0]
+
+
+def test_link_round_trips(main, serve, backends):
+    db, publisher = backends
+    db.collections['v2_users'] = {'user-1': {}}
+
+    async def test(client):
+        # The user is read once, later links know it exists.
+        calls = []
+        for _ in range(3):
+            before = db.calls
+            response = await client.get('/link-institute-email/%s/user-1' % institute_email(main))
+            assert response.status_code == 200
+            calls.append(db.calls - before)
+        return calls
+
+    assert serve(test) == [2, 1, 1]
+    confirmations = db.collections['v2_institute_confirmations']
+    assert len(confirmations) == 3
+    assert db.collections['v2_users']['user-1']['is_institution_verification_pending'] is True
+
+
+def test_link_of_an_unknown_user_writes_nothing(main, serve, backends):
+    db, publisher = backends
+
+    async def test(client):
+        return await client.get('/link-institute-email/%s/nobody' % institute_email(main))
+
+    serve(test)
+    assert db.commits == 0
+    assert not db.collections.get('v2_institute_confirmations')
+
+
+def test_confirm_round_trips(main, serve, backends):
+    db, publisher = backends
+    db.collections['v2_users'] = {'user-1': {}}
+    db.collections['v2_institute_confirmations'] = {'confirm-1': {'user': 'user-1', 'email': institute_email(main)}}
+
+    async def test(client):
+        before = db.calls
+        response = await client.get('/confirm-institute-email/confirm-1')
+        assert 'linked successfully' in response.text
+        return db.calls - before
+
+    assert serve(test) == 2
+    assert db.collections['v2_institute_confirmations'] == {}
+    user = db.collections['v2_users']['user-1']
+    assert user['is_institution_verification_pending'] is False
+    assert user['institute_name'] == main.store.all()[0]['name']
+
+
+def test_bulk_confirm_round_trips_and_orphans(main, serve, backends):
+    db, publisher = backends
+    db.collections['v2_users'] = {'user-%d' % i: {} for i in range(50)}
+    confirmations = db.collections['v2_institute_confirmations'] = {}
+    for i in range(500):
+        confirmations['confirm-%d' % i] = {'user': 'user-%d' % (i % 50), 'email': institute_email(main)}
+    # A deleted user, an email without a domain and no user at all.
+    confirmations['confirm-500'] = {'user': 'deleted-user', 'email': institute_email(main)}
+    confirmations['confirm-501'] = {'user': 'user-1', 'email': 'no-domain'}
+    confirmations['confirm-502'] = {'email': institute_email(main)}
+
+    async def test(client):
+        refused = await client.post('/confirm-institute-emails?limit=1000', headers={'X-Admin-Token': 'wrong'})
+        assert refused.status_code == 403
+        before = db.calls
+        response = await client.post('/confirm-institute-emails?limit=1000')
+        assert response.status_code == 200
+        return response.json(), db.calls - before
+
+    summary, calls = serve(test)
+    assert summary == {'confirmed': 500, 'unmatched': 0, 'invalid': 3, 'batches': 3}
+    # One query, then a user lookup and a commit per batch of 250.
+    assert calls == 1 + 2 * 3
+    assert confirmations == {}
+    assert 'deleted-user' not in db.collections['v2_users']
+    assert all(user['is_institution_verification_pending'] is False for user in db.collections['v2_users'].values())
+
+
+def test_shutdown_sends_queued_emails_and_retries(main, serve, backends, monkeypatch):
+    db, publisher = backends
+    db.collections['v2_users'] = {'user-%d' % i: {} for i in range(3)}
+    email = institute_email(main)
+    failures = []
+    sendmail = bench.FakeSMTP.sendmail
+
+    def fail_once(self, sender, receiver, message):
+        if not failures:
+            failures.append(receiver)
+            raise smtplib.SMTPException('try again')
+        sendmail(self, sender, receiver, message)
+
+    monkeypatch.setattr(bench.FakeSMTP, 'sendmail', fail_once)
+
+    async def test(client):
+        # The failed email waits a second for its retry, shutdown sends it now.
+        for i in range(3):
+            assert (await client.get('/link-institute-email/%s/user-%d' % (email, i))).status_code == 200
+
+    start = time.perf_counter()
+    serve(test)
+    assert time.perf_counter() - start < 1
+    assert failures == [email]
+    assert bench.FakeSMTP.receivers == {email: 3}
+    assert main.outbox.unsent == 0
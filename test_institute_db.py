@@ -0,0 +1,57 @@
+# python -m pytest test_institute_db.py
+#
+# SqliteInstituteStore writes, which run on the store's writer thread.
+import asyncio
+import sqlite3
+
+from institute_db import SqliteInstituteStore
+from institute_search import SearchIndex
+
+
+def institute(name):
+    return {'name': name, 'domains': [name.lower().replace(' ', '') + '.edu'], 'is_verified': True}
+
+
+def names(items):
+    return sorted(item['name'] for item in items)
+
+
+def test_a_locked_database_does_not_block_the_event_loop(tmp_path):
+    store = SqliteInstituteStore(str(tmp_path / 'institutes.db'))
+    store.load()
+    # Another worker's write transaction.
+    other = sqlite3.connect(str(tmp_path / 'institutes.db'), isolation_level=None)
+    other.execute('BEGIN IMMEDIATE')
+
+    async def run():
+        add = asyncio.ensure_future(store.add(institute('Locked College')))
+        # The loop keeps running while the writer thread waits for the lock.
+        await asyncio.sleep(0.2)
+        assert not add.done()
+        other.execute('COMMIT')
+        return await add
+
+    assert asyncio.run(run()) == 1
+    assert store.find('student@lockedcollege.edu')['name'] == 'Locked College'
+
+
+def test_edits_patch_the_search_index_until_another_worker_writes(tmp_path):
+    search = SearchIndex()
+    store = SqliteInstituteStore(str(tmp_path / 'institutes.db'), search=search)
+    other = SqliteInstituteStore(str(tmp_path / 'institutes.db'))
+    store.load()
+    other.load()
+
+    async def run():
+        assert search.search('zeta') == []
+        await asyncio.gather(store.add(institute('Zeta College')), store.add(institute('Zeta Two')))
+        assert names(search.search('zeta')) == ['Zeta College', 'Zeta Two']
+
+        await other.add(institute('Zeta Other'))
+        assert await store.delete('Zeta Two') == 1
+        assert names(search.search('zeta')) == ['Zeta College', 'Zeta Other']
+        assert await store.delete('Zeta Two') == 0
+        assert not await store.refresh()
+
+    asyncio.run(run())
+    assert store.version == store.current_version() == 4
@@ -0,0 +1,84 @@
+# python -m pytest test_pricing.py
+#
+# Property checks for pricing.py over seeded random prices, so every run
+# covers the same inputs.
+import decimal
+import math
+import random
+from decimal import Decimal
+
+import pytest
+
+import pricing
+from pricing import PriceError
+
+RUNS = 2000
+
+
+def prices(seed):
+    rng = random.Random(seed)
+    for _ in range(RUNS):
+        yield rng.choice([
+            lambda: round(rng.uniform(0, 1000), rng.randrange(4)),
+            lambda: '%d.%02d' % (rng.randrange(10 ** rng.randrange(1, 12)), rng.randrange(100)),
+            lambda: rng.randrange(10 ** 9),
+            lambda: '%de%d' % (rng.randrange(1, 10), rng.randrange(-40, 40)),
+            lambda: rng.uniform(-1e6, 1e6) * 10 ** rng.randrange(40),
+            lambda: rng.choice([math.inf, -math.inf, math.nan, None, '', 'abc', [], '-0.01', '1e100000']),
+        ])()
+
+
+def convert(price, quantum=pricing.CENT):
+    try:
+        return pricing.to_micros(price, quantum)
+    except PriceError:
+        return None
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_to_micros_returns_micros_or_raises_price_error(seed):
+    for price in prices(seed):
+        micros = convert(price)
+        assert micros is None or micros.isdigit()
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_to_micros_matches_the_rounded_price(seed):
+    for price in prices(seed):
+        micros = convert(price)
+        if micros is None:
+            continue
+        value = Decimal(repr(price) if isinstance(price, float) else price)
+        expected = value.quantize(pricing.CENT, rounding=decimal.ROUND_HALF_UP)
+        assert pricing.from_micros(micros) == expected
+        assert int(micros) % 10000 == 0
+
+
+@pytest.mark.parametrize('price', [1e30, '1e30', '9' * 27, '1e100000', 10 ** 40])
+def test_to_micros_rejects_prices_too_large_to_quantize(price):
+    with pytest.raises(PriceError):
+        pricing.to_micros(price)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_to_micros_batch_matches_to_micros(seed):
+    batch = list(prices(seed))
+    micros, errors = pricing.to_micros_batch(batch)
+    assert micros == [convert(price) for price in batch]
+    assert set(errors) == {i for i, value in enumerate(micros) if value is None}
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_derive_prices_rounds_to_the_currency_unit(seed):
+    rng = random.Random(seed)
+    for _ in range(RUNS // 10):
+        price_micros = rng.randrange(10 ** 12)
+        rates = {'JP': {'currency': 'jpy', 'rate': rng.uniform(0, 200)},
+                 'DE': {'currency': 'EUR', 'rate': '%de%d' % (rng.randrange(1, 10), rng.randrange(-5, 40))}}
+        try:
+            derived = pricing.derive_prices(price_micros, rates)
+        except PriceError:
+            continue
+        assert derived['JP']['currency'] == 'JPY'
+        assert int(derived['JP']['priceMicros']) % 1000000 == 0
+        assert int(derived['DE']['priceMicros']) % 10000 == 0